@@ -1,5 +1,12 @@
 # -*- coding: ISO-8859-1 -*-
 import os
+import sys
+import argparse
+import csv
+import json
+import sqlite3
+import re
+from io import BytesIO
 from pathlib import Path
 import pandas as pd
 import numpy as np
@@ -9,8 +16,9 @@ from random import random
 Photometry analysis.
 Read behavior and photometry database files from a sub-folder of wherever program is run from.
 Create a single text file of selected trials and binned photometry data
+Run without arguments for the interactive version, or with --batch for headless runs
+(python phanal.py --help for all options)
 """
-print("\nPhanal - February 2026 - Alain R. Marchand\n")
 
 Regions=1                                                   # 1 region (Iso+Sig), 2 regions (2 Iso+2 Sig)
 Behav_database_name, Photom_database_name=dict(), dict()
@@ -27,7 +35,13 @@ Photom_database_name[2]="Photom_data2.xls"
 Region_marker[0]=""
 Region_marker[1]="_1"
 Region_marker[2]="_2"
-First_column=6
+Database_ext=("", ".gz", ".xz")                         # plain or compressed databases, read as a stream
+Index_ext=".sqlite"                                         # SQLite index of behavior database, next to database
+Index_chunk=100_000                                      # rows read at once when building index
+Store_name="Trials.sqlite"                                # trial store written by phautom if Storage is sqlite
+Offsets_ext=".offsets"                                     # byte offset and check code of each row of photometry database
+Offset_chunk=64*2**20                                   # bytes scanned at once when building offsets
+Row_start=re.compile(rb"^[^\t\n]*\t([^\t\n]*)", re.M)      # first field (time) and check code of a row
 #_____________________________________________________________________________________
 
 Input_subdir="Database"                             # sub directory containing input data
@@ -38,17 +52,41 @@ Param_ext=".txt"
 Output_subdir="Events"                             # sub directory containing output data
 Event_ext=".xls"
 bins, zscore, maxi, mini, tmax, tmin, area, equal = 'bins', "z-score", "max", "min", "tmax", "tmin", "area", "="
-ignore_cols=6                                            # time	check	mean	stdev	gain	shift
+peaks, threshold, prominence = "peaks", "threshold", "prominence"
+Peak_metrics=("count", "amplitude", "rise", "rate")     # peaks or peaks=metric, see compute_peaks
+Peak_threshold=2.0                                          # minimum height of peaks (threshold=...), in units of data or z-score
+Peak_prominence=1.0                                        # minimum prominence of peaks (prominence=...)
+Z_score_columns={"epoch": ("mean", "stdev"),         # z-score or z-score=epoch: over whole epoch
+                            "baseline": ("bl_mean", "bl_stdev"),   # over Baseline_window of phautom
+                            "rolling": ("roll_mean", "roll_stdev")}   # over Rolling_window of session, centered on trial
+Z_group_levels=("animal", "cohort")                # z-score=animal or cohort: over all sessions of group, see group_statistics
+Z_statistics_name="Z_statistics.json"             # written by phautom next to databases if Group_z_score
 
 File_error="\n*** Error: cannot access file ***"
 Parameter_error="\n*** Error: invalid parameter ***"
 
+# exit codes (batch mode)
+Exit_ok=0
+Exit_error=1
+Exit_usage=2                                           # also used by argparse
+Exit_file=3                                              # missing or unreadable file
+Exit_parameter=4                                    # invalid analysis file
+Exit_database=5                                     # databases missing or inconsistent
+Interactive=True                                       # False in batch mode: no prompt, no keypress
+Compact_memory=False                             # True: trial data held as float32 (--compact)
+Use_index=False                                         # True: conditions are queried from a SQLite index (--index)
+Use_offsets=False                                       # True: selected rows of photometry database are read at their byte offsets (--seek)
+
 #==================================================        
 def get_parameters_from_file(parameter_file):
     """
     read parameter text file; empty lines and text after # are ignored
     specifies whether to convert data to z-scores
-        format is 'z-score'
+        format is 'z-score' or 'z-score=kind', kind is epoch, baseline or rolling (see Z_score_columns)
+        or animal or cohort (see Z_group_levels)
+    specifies peak detection metrics instead of bin averages
+        format is 'peaks' or 'peaks=metric', metric is count, amplitude, rise or rate (see compute_peaks)
+        optional 'threshold=value' and 'prominence=value' (see Peak_threshold and Peak_prominence)
     specifies a list of analysis bins
         format is 'bin=start, end, width' or 'bin=start, end'
         single bin if end=start+width
@@ -84,13 +122,26 @@ def get_parameters_from_file(parameter_file):
                         found=True
                         if valid_line.startswith(name+"=false"):
                             params[name]= False
+                        elif name==zscore and valid_line.startswith(name+equal):
+                            kind=valid_line.strip('\n').split(equal)[1]
+                            if not kind in Z_score_columns and not kind in Z_group_levels and kind!="true": raise ValueError
+                            params[name]= True if kind=="true" else kind
                         else:
                             params[name]= True
                         break
 
                 # bins
                 if not found:
-                    if valid_line.startswith(bins):
+                    if valid_line.startswith(peaks):
+                        kind=valid_line.strip('\n').split(equal)[1] if equal in valid_line else Peak_metrics[0]
+                        if not kind in Peak_metrics: raise ValueError
+                        params[peaks]=kind
+
+                    elif valid_line.startswith(threshold+equal) or valid_line.startswith(prominence+equal):
+                        name, value = valid_line.strip('\n').split(equal)
+                        params[name]=float(value)
+
+                    elif valid_line.startswith(bins):
                         valid_line=valid_line.replace(bins+"=","")
                         param_line=valid_line.split(",")                           # split line
                         if len(param_line)<3: raise ValueError
@@ -110,12 +161,12 @@ def get_parameters_from_file(parameter_file):
     except IOError:
         print(File_error)
         print(parameter_file,"\n")
-        ask_and_stop()
+        ask_and_stop(Exit_file)
         
     except ValueError:
         print(Parameter_error)
         print(valid_line)
-        ask_and_stop()
+        ask_and_stop(Exit_parameter)
         
     return params   
 
@@ -176,38 +227,360 @@ def make_trial_list(behav_lines, params):
     except ValueError:
         print("*** Error while testing conditions ***")
         print(name,"=",value)
-        ask_and_stop()
+        ask_and_stop(Exit_parameter)
         
     return trial_times
 
+#==================================================
+def quote(name):
+    """
+    column name as an SQL identifier
+    """
+    return '"'+name.replace('"', '""')+'"'
+
+#==================================================
+def index_lower(text):
+    """
+    lower case as str.lower in make_trial_list (SQLite lower only handles ASCII)
+    """
+    return text.lower() if isinstance(text, str) else text
+
+#==================================================
+def index_real(text):
+    """
+    number as float() in make_trial_list, None for nan, empty or non numerical text, so that no range contains it
+    (make_trial_list stops on non numerical text, an index must not fail while being updated)
+    """
+    try: value=float(text)
+    except (TypeError, ValueError): return None
+    return None if value!=value else value
+
+#==================================================
+def last_row(behav_name, end):
+    """
+    byte offset and text of the line ending at byte 'end' of a plain database (read backwards by chunks)
+    """
+    with open(behav_name, "rb") as behav_file:
+        position, buffer = end, b""
+        while position>0:
+            start=max(position-Offset_chunk, 0)
+            behav_file.seek(start)
+            buffer=behav_file.read(position-start)+buffer
+            position=start
+            newline=buffer.rfind(b"\n", 0, len(buffer)-1)
+            if newline>=0: return position+newline+1, buffer[newline+1:]
+    return 0, buffer
+
+#==================================================
+def row_check(line, titles):
+    """
+    check code of a behavior database row, as text (column title if line is the title line)
+    """
+    fields=line.rstrip(b"\r\n").split(b"\t")
+    column=titles.index("check") if "check" in titles else len(titles)-1
+    return fields[column].decode(errors="replace").strip() if column<len(fields) else ""
+
+#==================================================
+def open_index(behav_name):
+    """
+    open SQLite index of behavior database (table trials, row numbers as in database, lower case columns)
+    index is created if missing, completed with new rows if plain database was appended to,
+    and rebuilt if database was otherwise modified:
+    last indexed row (byte offset and check code, in meta) must be found unchanged before appending
+    Parameters
+    -----------
+       behav_name: full name of behavior database
+    Returns
+    -------
+       connection: an sqlite3 connection
+    """
+    try:
+        stat=os.stat(behav_name)
+        titles=[t.lower() for t in pd.read_csv(behav_name, sep='\t', quoting=csv.QUOTE_NONE, nrows=0).columns]
+        connection=sqlite3.connect(behav_name+Index_ext)
+        connection.create_function("py_lower", 1, index_lower, deterministic=True)    # needed by indexes of conditions
+        connection.create_function("py_real", 1, index_real, deterministic=True)
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            meta=dict(connection.execute("SELECT key, value FROM meta"))
+            if meta.get("size")==str(stat.st_size) and meta.get("mtime")==str(stat.st_mtime_ns):
+                return connection                                                          # up to date
+            appended=(meta.get("titles")=='\t'.join(titles) and os.path.splitext(behav_name)[1] not in Database_ext[1:]
+                                and int(meta.get("size", 0))<=stat.st_size)
+            rows=0
+            if appended and "last_offset" in meta:                                      # last indexed row unchanged
+                with open(behav_name, "rb") as behav_file:
+                    behav_file.seek(int(meta["last_offset"]))
+                    last=behav_file.readline()
+                appended=(int(meta["last_offset"])+len(last)==int(meta["size"]) and last.endswith(b"\n")
+                                and row_check(last, titles)==meta["last_check"])
+            else: appended=False
+            if appended:
+                rows=int(meta["rows"])
+                print("Updating index", os.path.basename(behav_name+Index_ext))
+                behav_file=open(behav_name, "rb")
+                behav_file.seek(int(meta["size"]))                                       # new rows only
+                chunks=pd.read_csv(behav_file, sep='\t', quoting=csv.QUOTE_NONE, header=None, names=titles, dtype=str, na_filter=False, chunksize=Index_chunk)
+            else:
+                print("Building index", os.path.basename(behav_name+Index_ext))
+                connection.execute("DROP TABLE IF EXISTS trials")
+                connection.execute("CREATE TABLE trials (row INTEGER PRIMARY KEY, "+", ".join(quote(t)+" TEXT" for t in titles)+")")
+                behav_file=None
+                chunks=pd.read_csv(behav_name, sep='\t', quoting=csv.QUOTE_NONE, dtype=str, na_filter=False, chunksize=Index_chunk)
+            insert="INSERT INTO trials VALUES (?"+", ?"*len(titles)+")"
+            for chunk in chunks:
+                connection.executemany(insert, zip(range(rows, rows+len(chunk)), *[chunk[c] for c in chunk.columns]))
+                rows+=len(chunk)
+            if behav_file: behav_file.close()
+            meta={"size": stat.st_size, "mtime": stat.st_mtime_ns, "rows": rows, "titles": '\t'.join(titles)}
+            if os.path.splitext(behav_name)[1] not in Database_ext[1:]:               # plain database, see appended
+                last_offset, last = last_row(behav_name, stat.st_size)
+                meta.update(last_offset=last_offset, last_check=row_check(last, titles))
+            connection.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [(k, str(v)) for k, v in meta.items()])
+
+    except (IOError, sqlite3.Error, pd.errors.ParserError) as error:
+        print(File_error, behav_name+Index_ext, "***\n", error)
+        ask_and_stop(Exit_database)
+
+    return connection
+
+#==================================================
+def index_columns(connection):
+    """
+    an empty data frame with the columns of the indexed behavior database
+    """
+    titles=[line[1] for line in connection.execute("PRAGMA table_info(trials)")][1:]      # after row
+    return pd.DataFrame(columns=titles)
+
+#==================================================
+def select_trials(connection, params):
+    """
+    select trials according to conditions, as make_trial_list, with an SQL query on the index
+    columns used in conditions are indexed (text and numerical values) on first use
+    Parameters
+    -----------
+        connection: an sqlite3 connection, see open_index
+        params: a dict {parameter_name: value}, includes conditions
+    Returns
+    -------
+        trial_times: a list of tuples (trial_number, check_code)
+    """
+    columns=list(index_columns(connection).columns)
+    conditions=[key for key in params.keys() if key in columns]
+    clauses, values = [], []
+    try:
+        for name in conditions:
+            value=params[name]
+            alternatives=[]                                                                     # 'or' condition
+            for v in value:
+                if isinstance(v, str) and ':' in v:                                     # detect range
+                    start, end = [float(x) for x in v.split(':')]
+                    alternatives+=["py_real("+quote(name)+") BETWEEN ? AND ?"]
+                    values+=[start, end]
+                else:                                                                            # a string or number
+                    alternatives+=["py_lower("+quote(name)+")=?"]
+                    values+=[str(v).lower()]
+            clauses+=["("+" OR ".join(alternatives)+")"]
+    except ValueError:
+        print("*** Error while testing conditions ***")
+        print(name,"=",value)
+        ask_and_stop(Exit_parameter)
+
+    query="SELECT row, "+quote("check")+" FROM trials"
+    if clauses: query+=" WHERE "+" AND ".join(clauses)                              # 'and' condition
+    with connection:
+        for name in conditions:
+            key=name.encode().hex()
+            connection.execute("CREATE INDEX IF NOT EXISTS py_text_"+key+" ON trials (py_lower("+quote(name)+"))")
+            connection.execute("CREATE INDEX IF NOT EXISTS py_real_"+key+" ON trials (py_real("+quote(name)+"))")
+    try:
+        for name in conditions:                                                         # make_trial_list stops on non numerical values
+            value=params[name]
+            if any(isinstance(v, str) and ':' in v for v in value):
+                for (text,) in connection.execute("SELECT "+quote(name)+" FROM trials WHERE py_real("+quote(name)+") IS NULL"):
+                    float(text)                                                               # only nan passes
+    except ValueError:
+        print("*** Error while testing conditions ***")
+        print(name,"=",value)
+        ask_and_stop(Exit_parameter)
+    return [(row, int(check)) for row, check in connection.execute(query+" ORDER BY row", values)]
+
+#==================================================
+def fetch_selected(connection, query, numbers):
+    """
+    lines of a query joined with temporary table selection (row), filled with numbers by chunks
+    """
+    lines=[]
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS selection (row INTEGER PRIMARY KEY)")
+    for i in range(0, len(numbers), Index_chunk):
+        connection.execute("DELETE FROM selection")
+        connection.executemany("INSERT INTO selection VALUES (?)", [(int(n),) for n in numbers[i:i+Index_chunk]])
+        lines+=connection.execute(query).fetchall()
+    return lines
+
+#==================================================
+def index_rows(connection, trial_numbers):
+    """
+    rows of behavior database from the index, as behav_lines.loc[trial_numbers]
+    """
+    columns=list(index_columns(connection).columns)
+    lines=fetch_selected(connection, "SELECT trials.* FROM trials JOIN selection USING (row) ORDER BY row", trial_numbers)
+    rows=pd.DataFrame(lines, columns=["row"]+columns).set_index("row")
+    rows.index.name=None
+    return rows.loc[trial_numbers]
+
+#==================================================
+def scan_offsets(photom_name, start=0):
+    """
+    byte offsets and check codes of rows following the line at byte 'start' (title line if 0)
+    file is scanned in chunks of whole lines, check code is the second field of each row (-1 if not a number)
+    Parameters
+    -----------
+       photom_name: full name of plain photometry database
+       start: byte offset of title line or of last row already indexed
+    Returns
+    -------
+       offsets: int64 array (rows, 2)
+    """
+    offsets=[]
+    with open(photom_name, "rb") as photom_file:
+        photom_file.seek(start)
+        position=start+len(photom_file.readline())
+        buffer=b""
+        while True:
+            chunk=photom_file.read(Offset_chunk)
+            buffer+=chunk
+            end=buffer.rfind(b"\n")+1 if chunk else len(buffer)        # whole lines, last line may lack a new line
+            for row in Row_start.finditer(buffer, 0, end):
+                offsets.append((position+row.start(), int(row.group(1)) if row.group(1).isdigit() else -1))
+            position, buffer = position+end, buffer[end:]
+            if not chunk: break
+    return np.array(offsets, dtype=np.int64).reshape(-1, 2)
+
+#==================================================
+def open_offsets(photom_name, rebuild=False):
+    """
+    read sidecar index of plain photometry database (Offsets_ext, int64 pairs written by phautom)
+    index is built if missing, completed with new rows if database was appended to,
+    and rebuilt if its last row does not match database
+    Parameters
+    -----------
+       photom_name: full name of plain photometry database
+       rebuild: if True, index is rebuilt from whole database
+    Returns
+    -------
+       offsets: int64 array (rows, 2), byte offset and check code of each row
+    """
+    offsets_name=photom_name+Offsets_ext
+    offsets, new = None, None
+    try:
+        if not rebuild and os.path.isfile(offsets_name):
+            try: offsets=np.fromfile(offsets_name, dtype=np.int64).reshape(-1, 2)
+            except ValueError: pass                                                      # truncated index
+        if offsets is not None and len(offsets):
+            with open(photom_name, "rb") as photom_file:
+                photom_file.seek(offsets[-1, 0])
+                last=photom_file.readline()
+            row=Row_start.match(last)
+            if not (row and row.group(1).isdigit() and int(row.group(1))==offsets[-1, 1]): offsets=None
+            elif offsets[-1, 0]+len(last)<os.path.getsize(photom_name):
+                print("Updating offsets", os.path.basename(offsets_name))
+                new=scan_offsets(photom_name, offsets[-1, 0])
+                offsets=np.concatenate((offsets, new))
+        if offsets is None or not len(offsets):
+            print("Building offsets", os.path.basename(offsets_name))
+            offsets=scan_offsets(photom_name)
+
+    except IOError:
+        print(File_error, photom_name,"***\n")
+        ask_and_stop(Exit_file)
+
+    try:
+        if new is not None:
+            with open(offsets_name, "ab") as offsets_file: offsets_file.write(new.tobytes())
+        elif rebuild or not os.path.isfile(offsets_name) or os.path.getsize(offsets_name)!=offsets.nbytes:
+            offsets.tofile(offsets_name+".tmp")
+            os.replace(offsets_name+".tmp", offsets_name)
+    except IOError:
+        print(File_error, offsets_name, "***")                               # not fatal, index kept in memory
+    return offsets
+
+#==================================================
+def offset_rows(photom_name, offsets, trial_numbers, data_type=float, rebuilt=False):
+    """
+    rows of photometry database read at their byte offsets, as pd_from_text_file(...).loc[trial_numbers]
+    rows are read in file order and parsed at once with the title line
+    if check codes do not match the index, index is rebuilt once (see open_offsets)
+    Parameters
+    -----------
+       photom_name: full name of plain photometry database
+       offsets: see open_offsets
+       trial_numbers: row numbers of selected trials
+       data_type: type of data columns (float or np.float32)
+    Returns
+    -------
+       a Pandas dataframe
+    """
+    rows=np.unique(np.asarray(trial_numbers, dtype=np.int64))             # sorted
+    if len(rows) and rows[-1]>=len(offsets):
+        if not rebuilt: return offset_rows(photom_name, open_offsets(photom_name, True), trial_numbers, data_type, True)
+        print("\n*** Error: Databases do not match ***")
+        ask_and_stop(Exit_database)
+    try:
+        with open(photom_name, "rb") as photom_file:
+            lines=[photom_file.readline()]                                          # title line
+            for offset in offsets[rows, 0]:
+                photom_file.seek(offset)
+                line=photom_file.readline()
+                lines.append(line if line.endswith(b"\n") else line+b"\n")
+    except IOError:
+        print(File_error, photom_name,"***\n")
+        ask_and_stop(Exit_file)
+
+    titles=lines[0].decode("latin-1").rstrip("\r\n").split("\t")
+    text_lines=pd.read_csv(BytesIO(b"".join(lines)), sep='\t', quoting=csv.QUOTE_NONE, dtype=text_dtypes(titles, float, data_type),
+                                       float_precision="round_trip")
+    if len(text_lines)!=len(rows) or not (text_lines["check"].to_numpy()==offsets[rows, 1]).all():
+        if not rebuilt: return offset_rows(photom_name, open_offsets(photom_name, True), trial_numbers, data_type, True)
+    text_lines.index=rows[:len(text_lines)]
+    return text_lines.loc[trial_numbers]
+
+#==================================================
+def text_dtypes(titles, convert=str, data_convert=None):
+    """
+    types of columns of a text database, see pd_from_text_file
+    """
+    dtypes={title: convert for title in titles}
+    if data_convert: dtypes.update({title: data_convert for title in titles[first_data_column(titles):]})
+    return dtypes
+
 #==================================================        
-def pd_from_text_file(text_name, convert=None):
+def pd_from_text_file(text_name, convert=str, data_convert=None):
     """
     read text data from .xls text file (processed data) into a Pandas dataframe
-    option to convert values into specified type
+    values are parsed directly into the specified type, without intermediate Python strings
     Parameters
     -----------
        text_name: full name of file
-       convert: optional, a type (int, float,...)
+       convert: optional, a type (str, float,...), str keeps text as is
+       data_convert: optional, a type for data columns, see first_data_column (e.g. np.float32)
     Returns
     -------
        text_lines: a Pandas dataframe
     """
     try:
-        with open(text_name, "r") as text_file:
-            titles=text_file.readline().strip('\n').split('\t')
-            lines=[l.strip('\n').split('\t') for l in text_file.readlines()]
-            text_lines=pd.DataFrame(lines)
-            if len(text_lines.columns)!=len(titles):
-                print("*** Anomaly: data found afer last column ***")
-                ask_and_stop()            
-            text_lines.columns=titles
-            # print(text_lines)
-            if convert: text_lines=text_lines.astype(convert)
+        titles=list(pd.read_csv(text_name, sep='\t', quoting=csv.QUOTE_NONE, nrows=0).columns)       # decompressed if .gz or .xz
+        text_lines=pd.read_csv(text_name, sep='\t', quoting=csv.QUOTE_NONE, dtype=text_dtypes(titles, convert, data_convert), na_filter=convert is not str,
+                                                float_precision="round_trip")
+        if not text_lines.index.equals(pd.RangeIndex(len(text_lines))):     # extra column taken as index
+            raise pd.errors.ParserError
             
     except IOError:
         print(File_error, text_name,"***\n")
-        ask_and_stop()                                                 # fatal error
+        ask_and_stop(Exit_file)                                    # fatal error
+    except pd.errors.ParserError:
+        print("*** Anomaly: data found afer last column ***")
+        ask_and_stop(Exit_database)
 
 ##    print(text_lines)
     return text_lines
@@ -223,13 +596,114 @@ def get_sampling_interval(data):
     -------
         Photom_interval: time interval between data columns in ms
     """
-    return int(data.columns[First_column+1]) - int(data.columns[First_column])
+    first=first_data_column(list(data.columns))
+    return int(data.columns[first+1]) - int(data.columns[first])
+
+#==================================================
+def first_data_column(titles):
+    """
+    index of first data column: data titles are times in ms,
+    id and normalization columns (time, check, mean, stdev, gain, shift...) are names
+    """
+    for i, title in enumerate(titles):
+        try:
+            int(title)
+            return i
+        except ValueError: pass
+    return len(titles)
     
+#==================================================
+def bin_name(k, start, step):
+    """
+    title of bin in event file: (interval number) start_end in seconds, or start if single sample
+    """
+    if step==Photom_interval: return "("+str(k+1)+") "+str(float(start/1000))
+    return "("+str(k+1)+") "+str(float(start/1000))+"_"+str(float((start+step)/1000))
+
+#==================================================
+def find_peaks(values, height, prominence):
+    """
+    thresholded local maxima with prominence, in all trials at once
+    a peak is a sample above its left neighbour, not below its right neighbour, and at least height
+    its prominence is its height above the higher of the lowest samples on each side,
+    searched until a higher sample or the end of the trial (as scipy.signal.peak_prominences)
+    sides are explored one sample at a time for all unresolved peaks together
+    Parameters
+    -----------
+        values: array (trials, samples)
+        height, prominence: minimum height and prominence of peaks
+    Returns
+    -------
+        found: boolean array (trials, samples), True at peaks
+        rise: array (trials, samples), number of rising samples before each sample
+    """
+    rising=np.zeros(values.shape, dtype=bool)
+    rising[:, 1:]=values[:, 1:]>values[:, :-1]
+    found=np.zeros(values.shape, dtype=bool)
+    found[:, 1:-1]=rising[:, 1:-1] & (values[:, 1:-1]>=values[:, 2:]) & (values[:, 1:-1]>=height)
+    index=np.arange(values.shape[1])
+    rise=index-np.maximum.accumulate(np.where(rising, 0, index), axis=1)     # distance to last sample not rising
+
+    peak_rows, peak_columns = np.nonzero(found)
+    top=values[peak_rows, peak_columns]
+    prominent=np.ones(len(top), dtype=bool)
+    for side in (-1, 1):
+        reached=np.zeros(len(top), dtype=bool)                       # top-prominence reached before a higher sample
+        position=peak_columns.copy()
+        pending=np.arange(len(top))
+        while pending.size:
+            position[pending]+=side
+            pending=pending[(position[pending]>=0) & (position[pending]<values.shape[1])]
+            sample=values[peak_rows[pending], position[pending]]
+            low=sample<=top[pending]-prominence
+            reached[pending[low]]=True
+            pending=pending[~low & (sample<=top[pending])]
+        prominent&=reached
+    found[peak_rows[~prominent], peak_columns[~prominent]]=False
+    return found, rise
+
+#==================================================
+def compute_peaks(data, params):
+    """
+    detect peaks over whole trials (see find_peaks), then compute a metric for each bin
+        count: number of peaks in bin
+        rate: peaks per second in bin
+        amplitude: mean height of peaks in bin (nan if none)
+        rise: mean rise time of peaks in bin, in ms (nan if none)
+    Parameters
+    -----------
+        data: data frame, selected trials, no id columns
+        params: a dict {parameter_name: value}
+    Returns
+    -------
+        histo: data frame, selected trials, no id columns
+    """
+    values=data.to_numpy(dtype=float)
+    found, rise = find_peaks(values, params.get(threshold, Peak_threshold), params.get(prominence, Peak_prominence))
+    counts=np.pad(np.cumsum(found, axis=1), ((0, 0), (1, 0)))                               # cumulative sums over samples
+    heights=np.pad(np.cumsum(np.where(found, values, 0), axis=1), ((0, 0), (1, 0)))
+    rises=np.pad(np.cumsum(np.where(found, rise, 0), axis=1), ((0, 0), (1, 0)))
+    position={title: i for i, title in enumerate(data.columns)}
+
+    histo={}
+    for k, (start, end, step) in enumerate(params["bins"]):
+        for i in range(start, end, step):
+            low, high = position[str(i)], position[str(i+step-Photom_interval)]+1
+            count=counts[:, high]-counts[:, low]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                if params[peaks]=="rate": column=count*1000/step
+                elif params[peaks]=="amplitude": column=(heights[:, high]-heights[:, low])/count
+                elif params[peaks]=="rise": column=(rises[:, high]-rises[:, low])*Photom_interval/count
+                else: column=count
+            histo[bin_name(k, i, step)]=column
+    return pd.DataFrame(histo, index=data.index)
+
 #==================================================
 def compute_histogram(data, params):
     """
     pool data into histogram with specified bins
     else compute max height and position for each bin if required
+    or peak metrics for each bin, see compute_peaks
     Parameters
     -----------
         data: data frame, selected trials, no id columns
@@ -238,6 +712,8 @@ def compute_histogram(data, params):
     -------
         histo: data frame, selected trials, no id columns
     """
+    if params.get(peaks, False): return compute_peaks(data, params)
+
     # extract intervals
     intervals=params["bins"]
     histo=pd.DataFrame()
@@ -246,8 +722,7 @@ def compute_histogram(data, params):
         for i in range(start, end, step):
             one_bin=data.loc[ : , [str(t) for t in range(i, i+step, Photom_interval)]]
 
-            name="("+str(k+1)+") "+str(float(i/1000))+"_"+str(float((i+step)/1000))
-            if step==Photom_interval: name="("+str(k+1)+") "+str(float(i/1000))
+            name=bin_name(k, i, step)
             
             if params.get(maxi, False):
                 histo[name]=one_bin.max(axis='columns')
@@ -292,7 +767,7 @@ def export_event_shapes(behav_select, histo, params):
             # write parameters
             param_list=[]
             for name, value in params.items():
-                param_list+=[name+'='+str(value)[1:-1] if not name in [zscore, area] else name+'='+str(value)]
+                param_list+=[name+'='+str(value)[1:-1] if not name in [zscore, area, peaks, threshold, prominence] else name+'='+str(value)]
             param_string="\n".join(param_list)    
             event_file.write("Parameters\n"+param_string+"\n")
 
@@ -311,19 +786,109 @@ def export_event_shapes(behav_select, histo, params):
 
     except IOError:
         print(File_error, event_filename," file may be open ***\n")
-        ask_and_stop()
+        ask_and_stop(Exit_file)
 
 #===================================================== 
-def get_regions(directory):
+def group_statistics(directory, region, behav_select, level):
+    """
+    mean and stdev of deltaF/F over all sessions of the animal or cohort of each trial
+    accumulated by phautom (Group_z_score) in Z_statistics_name, next to databases
+    Parameters
+    -----------
+        directory: directory of databases
+        region: 0, 1 or 2, as in database names
+        behav_select: data frame from behavior database with selected trials, animal and cohort columns
+        level: "animal" or "cohort"
+    Returns
+    -------
+        means, stdevs: arrays (trials)
+    """
+    statistics_name=os.path.join(directory, Z_statistics_name)
+    try:
+        with open(statistics_name, "r") as statistics_file:
+            groups=json.load(statistics_file)[level]
+        means, stdevs = np.array([groups[name][str(region)][1:] for name in behav_select[level]], dtype=float).reshape(-1, 2).T
+    except IOError:
+        print(File_error, statistics_name,"***\n")
+        ask_and_stop(Exit_file)
+    except (ValueError, KeyError) as error:
+        print("\n*** Error: no", level, "statistics for", error, "in", statistics_name, "***")
+        ask_and_stop(Exit_database)
+    return means, stdevs
+
+#==================================================
+def find_database(directory, name):
     """
-    check filenames to deterrmine the number of regions
+    full name of database, plain or compressed (first found in Database_ext order)
+    plain name if none exists
+    """
+    for ext in Database_ext:
+        if os.path.isfile(os.path.join(directory, name+ext)): return os.path.join(directory, name+ext)
+    return os.path.join(directory, name)
+
+#==================================================
+def find_store(directory):
+    """
+    full name of trial store, if directory has one and no behavior database, else None
+    """
+    if any(os.path.isfile(find_database(directory, name)) for name in Behav_database_name.values()): return None
+    store=os.path.join(directory, Store_name)
+    return store if os.path.isfile(store) else None
+
+#==================================================
+def store_behav(connection, region):
+    """
+    behavior rows of a region from trial store, as read from behavior database
+    trial ids serve as row numbers and check codes: trials and epochs are joined on id
+    """
+    lines=connection.execute("SELECT * FROM trials WHERE region=? ORDER BY id", (region,))
+    titles=[description[0] for description in lines.description]
+    behav_lines=pd.DataFrame(lines.fetchall(), columns=titles).set_index("id").drop(columns="region").fillna("")
+    behav_lines.index.name=None
+    behav_lines["check"]=behav_lines.index.astype(str)
+    return behav_lines
+
+#==================================================
+def store_photom(connection, trial_numbers, data_type=float):
+    """
+    photometry rows of selected trials from trial store, as read from photometry database
+    Parameters
+    -----------
+        connection: an sqlite3 connection to trial store
+        trial_numbers: trial ids, see store_behav
+        data_type: type of data columns (float or np.float32), samples are stored as float32
+    Returns
+    -------
+        photom_lines: a Pandas dataframe, check column holds trial ids
+    """
+    titles=dict(connection.execute("SELECT key, value FROM meta"))["epoch_titles"].split('\t')
+    columns=[line[1] for line in connection.execute("PRAGMA table_info(epochs)") if not line[1] in ("id", "samples")]
+    query="SELECT epochs.id, "+", ".join('epochs."'+c.replace('"', '""')+'"' for c in columns)+", epochs.samples"
+    lines=fetch_selected(connection, query+" FROM epochs JOIN selection ON epochs.id=selection.row ORDER BY epochs.id", trial_numbers)
+    ids=[line[0] for line in lines]
+    values=pd.DataFrame([line[1:-1] for line in lines], columns=columns, index=ids, dtype=float)
+    samples=np.frombuffer(b''.join(line[-1] for line in lines), dtype=np.float32).reshape(len(lines), len(titles))
+    photom_lines=pd.concat([values, pd.DataFrame(samples.astype(data_type), columns=titles, index=ids)], axis='columns')
+    photom_lines.insert(1, "check", photom_lines.index.astype(float))
+    return photom_lines.loc[trial_numbers]
+
+#==================================================        
+def get_regions(directory, store=None):
+    """
+    check filenames (or regions of trial store) to deterrmine the number of regions
     """
     Regions=1
-    if os.path.isfile(os.path.join(directory, Behav_database_name[2])): Regions=2
-    elif os.path.isfile(os.path.join(directory, Behav_database_name[0])): Regions=0 
-    elif not os.path.isfile(os.path.join(directory, Behav_database_name[1])):
+    if store:
+        keys=[key for (key,) in sqlite3.connect(store).execute("SELECT DISTINCT region FROM trials")]
+        if not keys:
+            print("\nError: trial store is empty !")
+            ask_and_stop(Exit_database)
+        Regions=max(keys)
+    elif os.path.isfile(find_database(directory, Behav_database_name[2])): Regions=2
+    elif os.path.isfile(find_database(directory, Behav_database_name[0])): Regions=0 
+    elif not os.path.isfile(find_database(directory, Behav_database_name[1])):
         print("\nError: no behavioral database !")
-        ask_and_stop()     
+        ask_and_stop(Exit_database)
     print('\n Analysing', max(Regions, 1), "region(s)")
     return Regions
                
@@ -339,80 +904,181 @@ def dialog(prompt):
     return txt
                
 #===================================================== 
-def ask_and_stop():    
+def ask_and_stop(code=Exit_error):
+    """
+    wait for a key before leaving (interactive mode)
+    in batch mode, leave at once with exit code
+    """
+    if not Interactive: sys.exit(code)
     print("Press a key to exit")
     try: input()                                                     
-    except ValueError: pass
-    os._exit(1)
+    except (ValueError, EOFError): pass
+    os._exit(code)
+
+#=====================================================
+def parse_arguments(argv=None):
+    """
+    command line options, all optional
+    without --batch, the analysis file is asked for and the program waits for a key at the end
+    """
+    parser=argparse.ArgumentParser(description="Select trials from photometry databases and bin their data")
+    parser.add_argument("-a", "--analysis",
+                        help="file describing the analysis, relative to events directory (asked if missing)")
+    parser.add_argument("-d", "--database-dir",
+                        help="directory containing the databases (default: ./"+Input_subdir+")")
+    parser.add_argument("-o", "--events-dir",
+                        help="directory containing analysis files and receiving event files (default: ./"+Output_subdir+")")
+    parser.add_argument("-r", "--regions", type=int, nargs="+", choices=(1, 2),
+                        help="regions to analyze (default: all regions found in databases)")
+    parser.add_argument("-b", "--batch", action="store_true",
+                        help="headless run: no prompt, no keypress; errors set the exit code")
+    parser.add_argument("-c", "--compact", action="store_true",
+                        help="hold trial data as float32, halves memory for large pooled databases")
+    parser.add_argument("-i", "--index", action="store_true",
+                        help="select trials with a SQLite index of the behavior database, kept next to it")
+    parser.add_argument("-s", "--seek", action="store_true",
+                        help="read only selected rows of plain photometry databases, at byte offsets kept next to them")
+    return parser.parse_args(argv)
 
 #================================================== MAIN PROGRAM
+def main(argv=None):
+    """
+    analyze selected trials of each region and write event files
+    Parameters
+    -----------
+        argv: list of command line arguments, default sys.argv[1:]
+    Returns
+    -------
+        exit code
+    """
+    global Interactive, Compact_memory, Use_index, Use_offsets, behav_lines, Photom_interval, event_filename
+    print("\nPhanal - February 2026 - Alain R. Marchand\n")
+    args=parse_arguments(argv)
+    Interactive=not args.batch
+    Compact_memory=Compact_memory or args.compact
+    Use_index=Use_index or args.index
+    Use_offsets=Use_offsets or args.seek
+    data_type=np.float32 if Compact_memory else float
 
-directory= os.getcwd()                                                        # current program and data directory
-directory_in= os.path.join(directory, Input_subdir)
-directory_out= os.path.join(directory, Output_subdir)
-if not os.path.isdir(directory_out):                                        # test if directory_out exists
-    print(File_error, directory_out,"***\n")
-    ask_and_stop()
-    
-print("Working on", directory)
-Regions=get_regions(directory_in)
-parameter_file=dialog("\nFile describing your analysis ")
-##parameter_file="params"
-if not parameter_file: ask_and_stop()
-
-for region in range(min(Regions, 1), max(Regions+1, 1)):
-    Behav_database=Behav_database_name[region]    
-    Photom_database=Photom_database_name[region]
-    region_marker=Region_marker[region]
-
-    # read behavior file in totality
-    behav_name=os.path.join(directory_in, Behav_database)
-    print("Opening", behav_name.split("\\")[-1])
-    behav_lines = pd_from_text_file(behav_name)
+    directory= os.getcwd()                                                        # current program and data directory
+    directory_in= args.database_dir or os.path.join(directory, Input_subdir)
+    directory_out= args.events_dir or os.path.join(directory, Output_subdir)
+    if not os.path.isdir(directory_out):                                        # test if directory_out exists
+        print(File_error, directory_out,"***\n")
+        ask_and_stop(Exit_file)
         
-    # read deltaF file in totality
-    photom_name=os.path.join(directory_in, Photom_database)
-    print("Opening", photom_name.split("\\")[-1])
-    photom_lines = pd_from_text_file(photom_name, convert=float)
-    Photom_interval=get_sampling_interval(photom_lines)                             
-        
-    # get parameters from file
-    parameter_file=os.path.join(directory_out, parameter_file)
+    print("Working on", directory_in)
+    store=find_store(directory_in)
+    if store and Use_index:
+        print("Trial store found, --index is not needed")
+        Use_index=False
+    Regions=get_regions(directory_in, store)
+    regions=range(min(Regions, 1), max(Regions+1, 1))
+    if args.regions and Regions:
+        if max(args.regions)>Regions:
+            print("\n*** Error: region", max(args.regions), "requested, databases have", Regions, "region(s) ***")
+            ask_and_stop(Exit_parameter)
+        regions=sorted(set(args.regions))
+
+    parameter_file=args.analysis
+    if parameter_file is None:
+        if not Interactive:
+            print("\n*** Error: --analysis is required in batch mode ***")
+            ask_and_stop(Exit_usage)
+        parameter_file=dialog("\nFile describing your analysis ")
+    ##parameter_file="params"
+    if not parameter_file: ask_and_stop(Exit_usage)
+    parameter_file=os.path.join(directory_out, parameter_file)                # once for all regions
     if not parameter_file.endswith(Param_ext): parameter_file+=Param_ext
-    params=get_parameters_from_file(parameter_file)
-    print("Parameters", params)
-
-    # build list of trials and select rows
-    trial_list=make_trial_list(behav_lines, params)
-    trial_numbers=[x[0] for x in trial_list]
-    if not trial_numbers: print("\n*** Selection is empty ***\n")
-    check_codes=[float(x[1]) for x in trial_list]
-    behav_select=behav_lines.loc[trial_numbers]
-    photom_select=photom_lines.loc[trial_numbers]
-    bad_select=photom_select.loc[(photom_select["check"]!=check_codes)]
-    if len(bad_select.index):
-        print("\n*** Error: Databases do not match ***")
-        ask_and_stop()
-        
-    # extract data
-    delta_f_f_select=photom_select.iloc[:, ignore_cols:].astype(float)
-
-    # compute histogram with z-scores if specified
-    if params.get(zscore, False):
-        mean_select=photom_select["mean"].astype(float)
-        stdev_select=photom_select["stdev"].astype(float)
-        z_score_select=delta_f_f_select.sub(mean_select, axis='rows')
-        z_score_select=z_score_select.div(stdev_select, axis='rows')
-        
-        histo=compute_histogram(z_score_select, params)
-    else: 
-        histo=compute_histogram(delta_f_f_select, params)
-        
-    # add to event file
-    event_filename=os.path.splitext(parameter_file)[0]+region_marker+Event_ext
-    export_event_shapes(behav_select, histo, params)
 
-print("Analysis complete")
-ask_and_stop()
+    for region in regions:
+        Behav_database=Behav_database_name[region]    
+        Photom_database=Photom_database_name[region]
+        region_marker=Region_marker[region]
+
+        # read behavior file in totality
+        behav_name=find_database(directory_in, Behav_database)
+        if store:
+            print("Opening", os.path.basename(store), "region", max(region, 1))
+            connection=sqlite3.connect(store)
+            behav_lines=store_behav(connection, region)
+        elif Use_index:
+            print("Opening", os.path.basename(behav_name))
+            connection=open_index(behav_name)
+            behav_lines=index_columns(connection)                              # rows are queried from index
+        else:
+            print("Opening", os.path.basename(behav_name))
+            behav_lines = pd_from_text_file(behav_name)
+            
+        # read deltaF file in totality
+        photom_name=find_database(directory_in, Photom_database)
+        offsets=None
+        if store:
+            photom_name=store
+            photom_lines=store_photom(connection, [], data_type)              # titles only, selected trials read below
+        elif Use_offsets and not photom_name.endswith(Database_ext[1:]):
+            print("Opening", os.path.basename(photom_name))
+            offsets=open_offsets(photom_name)
+            photom_lines=pd.read_csv(photom_name, sep='\t', quoting=csv.QUOTE_NONE, nrows=0)     # titles only, selected rows read below
+        else:
+            print("Opening", os.path.basename(photom_name))
+            photom_lines = pd_from_text_file(photom_name, convert=float, data_convert=data_type)
+        Photom_interval=get_sampling_interval(photom_lines)                             
+            
+        # get parameters from file
+        params=get_parameters_from_file(parameter_file)
+        print("Parameters", params)
+
+        # build list of trials and select rows
+        if Use_index:
+            trial_list=select_trials(connection, params)
+        else:
+            trial_list=make_trial_list(behav_lines, params)
+        trial_numbers=[x[0] for x in trial_list]
+        if not trial_numbers: print("\n*** Selection is empty ***\n")
+        check_codes=[float(x[1]) for x in trial_list]
+        behav_select=index_rows(connection, trial_numbers) if Use_index else behav_lines.loc[trial_numbers]
+        if store:
+            photom_select=store_photom(connection, trial_numbers, data_type)
+        elif offsets is not None:
+            photom_select=offset_rows(photom_name, offsets, trial_numbers, data_type)
+        else:
+            photom_select=photom_lines.loc[trial_numbers]
+        bad_select=photom_select.loc[(photom_select["check"]!=check_codes)]
+        if len(bad_select.index):
+            print("\n*** Error: Databases do not match ***")
+            ask_and_stop(Exit_database)
+            
+        # extract data
+        delta_f_f_select=photom_select.iloc[:, first_data_column(list(photom_select.columns)):]
+
+        # compute histogram with z-scores if specified
+        if params.get(zscore, False):
+            if params[zscore] in Z_group_levels:
+                means, stdevs = group_statistics(directory_in, region, behav_select, params[zscore])
+                mean_select=pd.Series(means, index=photom_select.index).astype(data_type)
+                stdev_select=pd.Series(stdevs, index=photom_select.index).astype(data_type)
+            else:
+                mean_column, stdev_column = Z_score_columns[params[zscore] if params[zscore] in Z_score_columns else "epoch"]
+                if not stdev_column in photom_select.columns:
+                    print("\n*** Error: no", params[zscore], "z parameters in database", os.path.basename(photom_name), "***")
+                    ask_and_stop(Exit_database)
+                mean_select=photom_select[mean_column].astype(data_type)
+                stdev_select=photom_select[stdev_column].astype(data_type)
+            z_score_select=delta_f_f_select.sub(mean_select, axis='rows')
+            z_score_select=z_score_select.div(stdev_select, axis='rows')
+            
+            histo=compute_histogram(z_score_select, params)
+        else: 
+            histo=compute_histogram(delta_f_f_select, params)
+            
+        # add to event file
+        event_filename=os.path.splitext(parameter_file)[0]+region_marker+Event_ext
+        export_event_shapes(behav_select, histo, params)
 
+    print("Analysis complete")
+    if Interactive: ask_and_stop(Exit_ok)
+    return Exit_ok
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,24 @@
 # -*- coding: ISO-8859-1 -*-
+import time
+Import_start=time.perf_counter()
 import os
+import sys
+import ast
+import hashlib
+import argparse
+import fnmatch
+import threading
+from queue import Queue, Full
 from pathlib import Path
+from dataclasses import dataclass, field, fields, replace
 import pandas as pd
-import time
 import json
 import numpy as np
-import pylab as graph
+from numpy.lib.stride_tricks import sliding_window_view
 from random import random
-import tkinter as tk
-from tkinter import ttk
+# matplotlib and tkinter are imported when first needed, by plot(), render_qc() and set_parameters(),
+# concurrent.futures, gzip, lzma and sqlite3 by the functions that use them
+Import_time=time.perf_counter()-Import_start
 
 """
 Photometry analysis.
@@ -18,11 +28,19 @@ defined in parameters_photometry.py and parameters_behavior.py.
 Events are aligned using a blind procedure exploring all possible offsets between Min_offset and Max_offset.
 Times are matched within an approximation range.
 Create two corresponding databases of tagged trials and analyzed photometry data
+Run without arguments for the interactive version, or with --batch for headless runs
+(python phautom_17b.py --help for all options)
+
+Can also be imported: parameters are held in a Config object passed to each step
+    cfg=Config.from_json(Param_file)
+    behav_lines, behav_times, photom_times = read_session(behav_name, cfg)           # ingest
+    offset, matches, fit, bias, size = align(behav_times, photom_times, cfg.Approximation, cfg.Min_offset, cfg.Max_offset)
+    control, linear_fit, delta_f, delta_f_f = normalize(sig, iso, cfg)                 # normalize
+    epochs, means, stdevs = extract_epochs(tim, delta_f_f, times, cfg)                # epoch
+or process_session(behav_name, cfg, directory_out) for all steps of one session
 """
-print("\nPhautom - 12/03/2025 - Alain R. Marchand\n")
-
 Session_info=None #(18, 20)
-Use_columns, Photom_columns, Iso, Sig=dict(), dict(), dict(), dict()
+Photom_columns, Iso, Sig=dict(), dict(), dict()
 Behav_database_name, Photom_database_name=dict(), dict()
 
 Param_file='phautom_parameters.json'          # some parameters will be read from Param_file
@@ -48,26 +66,56 @@ Param_file='phautom_parameters.json'          # some parameters will be read fro
     "Divide_by_mean": "False",
     "Keep_DC_level": "False",
     "Detrend": "True",
-    "Visualize": "False"
+    "Visualize": "False",
+    "Drift_correction": "False",
+    "Max_drift": 200,
+    "Output_interval": 0,
+    "Compact_memory": "False",
+    "Compression": "",
+    "QC_plots": "False",
+    "Baseline_window": "[-5000, -1000]",
+    "Rolling_window": 0,
+    "Robust_regression": "False",
+    "Regression_window": 0,
+    "Glitch_removal": "interpolate",
+    "Glitch_window": 1000,
+    "Glitch_threshold": 6,
+    "Filter": "gaussian",
+    "Filter_cutoff": 5,
+    "Filter_order": 2,
+    "Storage": "text",
+    "Transients": "True",
+    "Transient_window": 10000,
+    "Transient_threshold": 3,
+    "Group_z_score": "True"
 }
 """
-# json check
-not_bool=["Photom_marker", "TTL_on", "Align_on", "Synchro_codes"] # string parameters
-
 # synchronization parameters (adjust for best alignment)
 Refine=8                                                      # accuracy in ms for intermediate alignment
 Reliability_threshold=0.8                             # triggers warning message if matches less than                  
 ask_offset=False
 
+# regression parameters (see fit_control)
+Huber_k=1.345                                         # residuals above Huber_k robust stdevs are down-weighted
+IRLS_iterations=10                                   # reweighting iterations of robust regression
+
+# glitch parameters (see find_glitches)
+Glitch_modes=("", "flag", "interpolate")
+Glitch_steps=4                                          # rolling medians computed per window width, interpolated in between
+Median_chunk=1_000_000                              # samples of strided windows sorted at once by rolling_median
+
+# low-pass filter parameters (see low_pass)
+Filter_modes=("", "moving_average", "gaussian", "butterworth")
+
 # photometry file parameters
 Input_subdir="Data"                                   # sub directory containing input data
 Photom_ext=".csv"                                     # extension for photometry files
 Photom_skip_header=1                               # header lines to ignore before column titles
-Use_columns[1]=(0,1,2,3)                           # read time, control and signal
-Use_columns[2]=(0,1,4,5)                           # read time, control and signal if 2 regions
 Photom_columns[1]=(0,2,3)                        # time, control and signal
 Photom_columns[2]=(0,4,5)                        # time, control and signal if 2 regions
 Photom_marker_column=1                         # marker column
+Prefetch_sessions=0                                   # sessions read ahead in a background thread (--prefetch), 0: none
+Scan_threads=16                                     # directories listed in parallel (network drives)
 Iso[1], Iso[2]="CH1-410", "CH2-410"          # column titles
 Sig[1], Sig[2]="CH1-470", "CH2-470"          # column titles
 Timestamp="TimeStamp"                            # column titles
@@ -81,7 +129,7 @@ Sheet_name="essais"                                  # Excel data sheet containi
 Time_column="temps"
 Event_column="event"
 Reward_column="reward"
-Behav_header_size=0                                  # header lines to ignore
+Behav_header_size=0                                  # header lines to ignore before column titles
 ##Behav_time=100                                 # time base in milliseconds
 Behav_time_Whanda=1000                # time base in milliseconds
 Behav_time_unit=1000                                # unit for analysed data in milliseconds
@@ -91,16 +139,232 @@ Event_code_size=-2                                      # keep only the last cha
 
 # Output parameters
 Output_subdir="Database"                       # sub directory containing output data
-Logs_subdir="Database\\Logs"                       # sub directory containing log data
+Logs_subdir="Logs"                                   # sub directory of output directory containing log data
+Cache_subdir="Cache"                              # sub directory of output directory containing alignment results
+Shortcut_cache="Shortcuts.json"                   # targets of shortcuts in Cache_subdir, see get_shortcut_file_list
+Behav_cache_ext=".npz"                             # parsed behavior sheets in Cache_subdir, see read_behav_file
+QC_subdir="QC"                                       # sub directory of output directory containing QC figures
+TTL_anchor="TTL"                                     # sub directory of epochs aligned on TTL events, when Align_on is a list
+Transients_subdir="Transients"                     # sub directory of output directory containing transient tables
+Transients_ext=".txt"
+Z_statistics_name="Z_statistics.json"             # deltaF/F moments of sessions, animals and cohorts, if Group_z_score
+QC_ext=".png"
+Behav_database_name[0]="Behav_data.xls"          # single region
+Photom_database_name[0]="Photom_data.xls"
+Behav_database_name[1]="Behav_data1.xls"
+Photom_database_name[1]="Photom_data1.xls"
 Behav_database_name[2]="Behav_data2.xls"
 Photom_database_name[2]="Photom_data2.xls"
-# see below for names #1
+Compression_ext={"": "", "gzip": ".gz", "lzma": ".xz"}      # added to database names if compressed
+Gzip_level=6                                                             # compression level, 9 is much slower for little gain
+Offsets_ext=".offsets"                                                  # byte offset and check code of each row of plain photometry database
+Store_name="Trials.sqlite"                          # trial store, if Storage is sqlite
+Storage_modes=("text", "sqlite")
 Log_summary_name="Log_summary.txt"
 Log_ext=".txt"
 
 File_error="\n*** Error: cannot access file:"
 Time_base_error="\n*** Error: time base does not match in file:"
 Pause_time=2
+Plot_points=4000                                      # most points drawn per trace, as min/max envelope
+Import_time_budget=0.5                           # seconds, module imports above this are reported in batch mode
+
+# exit codes (batch mode)
+Exit_ok=0
+Exit_error=1
+Exit_usage=2                                           # also used by argparse
+Exit_file=3                                              # missing or unreadable file
+Exit_parameter=4                                    # invalid parameter file or missing column
+Exit_alignment=5                                    # some sessions could not be aligned
+Interactive=True                                       # False in batch mode: no window, no keypress
+
+#==================================================
+class PhautomError(Exception):
+    """
+    fatal error of a processing step, message already printed
+    main() converts it to its exit code (and waits for a key in interactive mode)
+    """
+    def __init__(self, code=Exit_error):
+        super().__init__(code)
+        self.code=code
+
+#==================================================
+@dataclass
+class Config:
+    """
+    parameters read from Param_file, one attribute per json key
+    defaults are used for keys missing from the file
+    """
+    Regions: int=1
+    Behav_time: float=100                              # time base of behavior file in milliseconds
+    Min_offset: int=0
+    Max_offset: int=120000
+    Minus_window: int=-5000
+    Plus_window: int=4000
+    Photom_interval: int=20
+    Approximation: int=30
+    Ignore_first_seconds: float=5
+    Photom_marker: str="*0;"
+    TTL_on: str="t_appui"
+    Align_on: str="t_appui"                           # event column of epochs ("": TTL), or a list of columns or [column, Minus_window, Plus_window]
+    Synchro_codes: dict=field(default_factory=lambda: {'P1': [0], 'P2': [0, 600], 'P3': [0, 600, 1200], 'D1': [1800], 'A1': [1800]})
+    Add_reward: bool=True
+    Globalize_z_score: bool=False
+    Linear_regression: bool=True
+    Divide_by_mean: bool=False
+    Keep_DC_level: bool=False
+    Detrend: bool=False
+    Visualize: bool=False
+    Drift_correction: bool=False                      # fit a linear clock drift with align_drift
+    Max_drift: float=200                                 # largest clock drift expected, in parts per million
+    Output_interval: int=0                              # sampling of epochs in ms, multiple of Photom_interval (0: same)
+    Compact_memory: bool=False                    # hold signals and epochs as float32
+    Compression: str=""                                  # databases written through "gzip" or "lzma" ("": plain text)
+    QC_plots: bool=False                               # write a QC figure (png) for each session and region
+    Baseline_window: list=field(default_factory=list)   # [start, end] in ms around trial, for baseline z parameters ([]: none)
+    Rolling_window: int=0                               # width in ms of session window centered on trial, for rolling z parameters (0: none)
+    Robust_regression: bool=False                  # Huber weights (IRLS) in fit of iso to signal, limits influence of artifacts
+    Regression_window: int=0                         # width in ms of piecewise fit centered on each sample (0: global fit)
+    Glitch_removal: str=""                              # "flag" or "interpolate" samples far from rolling median ("": none)
+    Glitch_window: int=1000                          # width in ms of rolling median
+    Glitch_threshold: float=6                          # distance to rolling median, in robust stdevs (MAD)
+    Filter: str=""                                          # low-pass of deltaF/F before epochs: "moving_average", "gaussian" or "butterworth" ("": none)
+    Filter_cutoff: float=5                               # cutoff frequency (-3 dB) in Hz
+    Filter_order: int=2                                  # order of butterworth filter
+    Storage: str="text"                                  # "text": paired Behav/Photom databases, "sqlite": trial store (Store_name)
+    Transients: bool=False                             # detect transients over whole sessions, see find_transients
+    Transient_window: int=10000                     # width in ms of rolling median and MAD of deltaF/F
+    Transient_threshold: float=3                     # height above rolling median, in robust stdevs (MAD)
+    Group_z_score: bool=False                        # accumulate deltaF/F mean and stdev per animal and cohort (Z_statistics_name)
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        """
+        check and convert values read from json file
+        booleans may be written as text (true, false, yes, no, oui, non...)
+        Synchro_codes and Baseline_window may be written as the text of a dict or list, Align_on as the text of a list
+        """
+        faux=["f", "n", "no", "non", "false"]
+        booleans=["v", "o", "y", "yes", "oui", "true"]+faux
+        types={f.name: f.type for f in fields(cls)}
+        values={}
+        for k, v  in parameters.items():
+            if not k in types:
+                print("\nUnknown parameter", k, ":", v)
+                raise PhautomError(Exit_parameter)
+            if types[k] is bool and isinstance(v, str):              # make sure booleans are recognized
+                if v.lower().strip(' ') in booleans:
+                    v=not(v.lower().strip(' ') in faux)
+                else:
+                    print("\nIncorrect parameter", k, ":", v)
+                    print("Allowed values are :", booleans)
+                    raise PhautomError(Exit_parameter)
+            elif isinstance(v, str) and (types[k] in (dict, list) or k=="Align_on" and v.lstrip().startswith("[")):   # convert string to dict or list
+                try: v=ast.literal_eval(v)
+                except (ValueError, SyntaxError):
+                    print("\nIncorrect parameter", k, ":", v)
+                    raise PhautomError(Exit_parameter)
+            values[k]=v
+        cfg=cls(**values)
+        anchors=[cfg.Align_on] if isinstance(cfg.Align_on, str) else cfg.Align_on
+        if not (isinstance(anchors, list) and anchors and
+                all(isinstance(anchor, str) or isinstance(anchor, (list, tuple)) and len(anchor)==3 and isinstance(anchor[0], str)
+                    and anchor[1]<anchor[2] for anchor in anchors) and
+                len({column for column, minus, plus in cfg.anchors})==len(anchors)):
+            print("\nIncorrect parameter Align_on :", cfg.Align_on)
+            print("Must be a column, or a list of distinct columns or [column, Minus_window, Plus_window]")
+            raise PhautomError(Exit_parameter)
+        if cfg.Output_interval and (cfg.Output_interval<cfg.Photom_interval or cfg.Output_interval%cfg.Photom_interval):
+            print("\nIncorrect parameter Output_interval :", cfg.Output_interval)
+            print("Must be a multiple of Photom_interval :", cfg.Photom_interval)
+            raise PhautomError(Exit_parameter)
+        if cfg.Baseline_window and not (len(cfg.Baseline_window)==2 and
+                                        all(minus<=cfg.Baseline_window[0]<cfg.Baseline_window[1]<=plus for column, minus, plus in cfg.anchors)):
+            print("\nIncorrect parameter Baseline_window :", cfg.Baseline_window)
+            print("Must be [start, end] within Minus_window and Plus_window (of each anchor)")
+            raise PhautomError(Exit_parameter)
+        if not cfg.Glitch_removal in Glitch_modes:
+            print("\nIncorrect parameter Glitch_removal :", cfg.Glitch_removal)
+            print("Allowed values are :", list(Glitch_modes))
+            raise PhautomError(Exit_parameter)
+        if not cfg.Filter in Filter_modes:
+            print("\nIncorrect parameter Filter :", cfg.Filter)
+            print("Allowed values are :", list(Filter_modes))
+            raise PhautomError(Exit_parameter)
+        if cfg.Filter and not 0<cfg.Filter_cutoff<500/cfg.Photom_interval:
+            print("\nIncorrect parameter Filter_cutoff :", cfg.Filter_cutoff)
+            print("Must be positive and below half the sampling rate :", 500/cfg.Photom_interval, "Hz")
+            raise PhautomError(Exit_parameter)
+        if cfg.Transients and cfg.Transient_window<3*cfg.Photom_interval:
+            print("\nIncorrect parameter Transient_window :", cfg.Transient_window)
+            print("Must be at least 3 samples :", 3*cfg.Photom_interval, "ms")
+            raise PhautomError(Exit_parameter)
+        if not cfg.Storage in Storage_modes:
+            print("\nIncorrect parameter Storage :", cfg.Storage)
+            print("Allowed values are :", list(Storage_modes))
+            raise PhautomError(Exit_parameter)
+        if not cfg.Compression in Compression_ext:
+            print("\nIncorrect parameter Compression :", cfg.Compression)
+            print("Allowed values are :", list(Compression_ext))
+            raise PhautomError(Exit_parameter)
+        return cfg
+
+    @classmethod
+    def from_json(cls, filename):
+        return cls.from_parameters(load_parameters_from_json(filename))
+
+    @property
+    def output_interval(self):
+        """
+        sampling interval of epochs in ms
+        """
+        return self.Output_interval or self.Photom_interval
+
+    @property
+    def decimation(self):
+        """
+        number of photometry samples per epoch sample
+        """
+        return self.output_interval//self.Photom_interval
+
+    @property
+    def signal_dtype(self):
+        """
+        type of photometry signal arrays, timestamps remain float64
+        """
+        return np.float32 if self.Compact_memory else float
+
+    @property
+    def anchors(self):
+        """
+        events of epochs, a list of (column, Minus_window, Plus_window), column "" for TTL events
+        """
+        if isinstance(self.Align_on, str): return [(self.Align_on, self.Minus_window, self.Plus_window)]
+        return [(anchor, self.Minus_window, self.Plus_window) if isinstance(anchor, str) else tuple(anchor)
+                for anchor in self.Align_on]
+
+    def anchor_configs(self, directory_out):
+        """
+        one (Config, directory) per anchor: Config aligned on anchor with its windows, directory of its databases
+        a list of anchors writes each in a sub directory of directory_out named after its column (TTL_anchor for "")
+        """
+        if isinstance(self.Align_on, str): return [(self, directory_out)]
+        return [(replace(self, Align_on=column, Minus_window=minus, Plus_window=plus), os.path.join(directory_out, column or TTL_anchor))
+                for column, minus, plus in self.anchors]
+
+    def region_key(self, region):
+        """
+        key of region in database names and trial store: 0 if single region
+        """
+        return region if self.Regions==2 else 0
+
+    def database_names(self, region):
+        """
+        behavior and photometry database names for region 1 or 2, with extension of compressed files
+        """
+        key=self.region_key(region)
+        ext=Compression_ext[self.Compression]
+        return Behav_database_name[key]+ext, Photom_database_name[key]+ext
 
 #==================================================
 def load_parameters_from_json(filename):
@@ -119,10 +383,10 @@ def load_parameters_from_json(filename):
         return parameters
     except FileNotFoundError:
         print(f"File '{filename}' not found.")
-        exit_on_keypress()
+        raise PhautomError(Exit_file)
     except json.JSONDecodeError:
         print(f"Error decoding JSON from file '{filename}'.")
-        exit_on_keypress()
+        raise PhautomError(Exit_parameter)
         
 #==================================================
 def save_parameters_to_json(filename, parameters):
@@ -149,6 +413,8 @@ class ParameterEditor:
         self.create_widgets()
 
     def create_widgets(self):
+        import tkinter as tk
+        from tkinter import ttk
         # Create labels and entry widgets for each parameter, in two columns
         row, col = 0, 0                                   # column variable to alternate between columns
         for i, (key, value) in enumerate(self.parameters.items()):
@@ -167,6 +433,7 @@ class ParameterEditor:
         save_button.grid(row=row+1, columnspan=4, pady=10)  # Span across two columns
 
     def save_parameters(self):
+        from tkinter import ttk
         # Update the parameters with the values from the entry widgets       
         for i, widget in enumerate(self.master.winfo_children()):
             if isinstance(widget, ttk.Label):
@@ -202,6 +469,7 @@ def set_parameters(parameter_file):
     parameters = load_parameters_from_json(parameter_file)
 
     if parameters:
+        import tkinter as tk                                           # GUI loaded only when parameters are edited
         root = tk.Tk()
         editor = ParameterEditor(root, parameters, parameter_file)
         root.mainloop()
@@ -211,57 +479,121 @@ def set_parameters(parameter_file):
 #==================================================
 def make_subdir(dirname):
     """
-    try creating directory, ignore if directory exists
+    try creating directory (and parents), ignore if directory exists
     """
-    try:
-        os.mkdir(dirname)
-    except FileExistsError: pass
+    os.makedirs(dirname, exist_ok=True)
         
 #==================================================
-def find_files(directory_in, Behav_ext, stop=True):
+def scan_directory(directory):
+    """
+    files and sub-directories of a directory (os.scandir: no stat call on most systems)
+    """
+    with os.scandir(directory) as entries:
+        entries=list(entries)
+    return [entry.path for entry in entries if entry.is_file()], [entry.path for entry in entries if entry.is_dir()]
+
+#==================================================
+def scan_tree(directory_in, recursive=False, include=(), exclude=()):
+    """
+    list files of directory_in, and of all its sub-directories if recursive
+    directories of each level are scanned in parallel threads (network drives)
+    Parameters
+    -----------
+        directory_in: top directory
+        recursive: True to explore sub-directories (e.g. cohort/animal/day)
+        include, exclude: lists of patterns (fnmatch) of paths relative to directory_in, with /
+            files are kept if they match an include pattern (all if none) and no exclude pattern
+    Returns
+    -------
+        filelist: sorted list of full names
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    filelist, pending = [], [directory_in]
+    with ThreadPoolExecutor(max_workers=Scan_threads) as pool:
+        while pending:
+            results=list(pool.map(scan_directory, pending))
+            filelist+=[name for names, subdirs in results for name in names]
+            pending=[subdir for names, subdirs in results for subdir in subdirs] if recursive else []
+
+    include, exclude = [[os.path.normcase(pattern).replace(os.sep, "/") for pattern in patterns] for patterns in (include, exclude)]
+    def selected(name):
+        relative=os.path.normcase(os.path.relpath(name, directory_in)).replace(os.sep, "/")
+        if include and not any(fnmatch.fnmatch(relative, pattern) for pattern in include): return False
+        return not any(fnmatch.fnmatch(relative, pattern) for pattern in exclude)
+    return sorted(name for name in filelist if selected(name))
+
+#==================================================
+def find_files(directory_in, Behav_ext, stop=True, recursive=False, include=(), exclude=(), cache_dir=None):
     behav_list=[]
     try:
-        filelist = [os.path.normcase(name) for name in os.listdir(directory_in)]
-        behav_list = [os.path.join(directory_in, name)                   # select behavior files
-                    for name in filelist if os.path.splitext(name)[1] == Behav_ext]
+        filelist = [os.path.join(os.path.dirname(name), os.path.normcase(os.path.basename(name)))
+                        for name in scan_tree(directory_in, recursive, include, exclude)]
+        behav_list = [name for name in filelist if os.path.splitext(name)[1] == Behav_ext]   # select behavior files
 
         if not behav_list:
-            behav_list = get_shortcut_file_list(directory_in,  Behav_ext, stop=stop)
+            behav_list = get_shortcut_file_list(filelist,  Behav_ext, stop=stop, cache_dir=cache_dir)
         
         if not behav_list and stop:
             print("\n*** No files found. Please verify file type ***")
-            exit_on_keypress()
+            raise PhautomError(Exit_file)
             
     except IOError:
         print(File_error, directory_in,"***\n") 
-        exit_on_keypress()
+        raise PhautomError(Exit_file)
         
     return behav_list        
 #=====================================================
-def get_file_list(directory_in,  Behav_ext, Behav_ext_WhandA, Behav_time, Behav_time_Whanda):
-    behav_list = find_files(directory_in, Behav_ext, stop=False)
+def get_file_list(directory_in,  Behav_ext, Behav_ext_WhandA, Behav_time, Behav_time_Whanda, **options):
+    """
+    behavior files of directory_in (or targets of its shortcuts), xlsx or else WhandA
+    options: recursive, include, exclude and cache_dir, see scan_tree and get_shortcut_file_list
+    """
+    behav_list = find_files(directory_in, Behav_ext, stop=False, **options)
     
     if not behav_list:
         Behav_ext=Behav_ext_WhandA
         Behav_time=Behav_time_Whanda
-        behav_list = find_files(directory_in, Behav_ext, stop=False)
+        behav_list = find_files(directory_in, Behav_ext, stop=False, **options)
         
     return behav_list, Behav_time
 
 #=============================================================
-def get_shortcut_file_list(directory_in,  Datafile_extension, stop=True):                                                   
+def get_shortcut_file_list(filelist,  Datafile_extension, stop=True, cache_dir=None):                                                   
         """
-        get list of files from shortcuts in data directory 
+        get list of files from shortcuts among files of data directory (see scan_tree)
+        targets are cached in cache_dir (Shortcut_cache), keyed by shortcut name and mtime:
+        a shortcut is read again only if it was modified
         """
-        dirlist=os.listdir(directory_in)
-        shortcutlist=[os.path.join(directory_in, name)
-                      for name in dirlist if os.path.splitext(name)[1] == ".lnk"]                           
+        shortcutlist=[name for name in filelist if os.path.splitext(name)[1] == ".lnk"]                           
         if not shortcutlist and stop:
             print("*** No shortcut to data found ***")
             raise ReferenceError
 
-        datalist=[get_target(name) for name in shortcutlist]
-        datalist=[name  for name in datalist if os.path.splitext(name)[1] == Datafile_extension]
+        cache_name=os.path.join(cache_dir, Shortcut_cache) if cache_dir else None
+        cache={}
+        if cache_name and os.path.isfile(cache_name):
+            try:
+                with open(cache_name, "r") as cache_file:
+                    cache=json.load(cache_file)
+            except (IOError, ValueError): cache={}
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=Scan_threads) as pool:
+            mtimes=list(pool.map(lambda name: os.stat(name).st_mtime_ns, shortcutlist))     # parallel stat
+        targets={}
+        for name, mtime in zip(shortcutlist, mtimes):
+            mtime_target=cache.get(name)
+            targets[name]=mtime_target if mtime_target and mtime_target[0]==mtime else [mtime, get_target(name)]
+
+        if cache_name and os.path.isdir(cache_dir) and targets!=cache:
+            try:
+                with open(cache_name+".tmp"+str(os.getpid()), "w") as cache_file:
+                    json.dump(targets, cache_file)
+                os.replace(cache_name+".tmp"+str(os.getpid()), cache_name)            # atomic
+            except IOError: pass                                                                     # cache is optional
+
+        datalist=[target for mtime, target in targets.values()]
+        datalist=[name  for name in datalist if name and os.path.splitext(name)[1] == Datafile_extension]
             
         return datalist
     
@@ -291,10 +623,11 @@ def get_target(shortcut):
                     return text
 
 #==================================================
-def check_sampling_interval(photom_file, Photom_interval, Photom_time_base):
+def check_sampling_interval(photom_name, Photom_interval, Photom_time_base):
     """
     read the first lines of photometry file to verify sampling interval
     """
+    interval=None
     try:
         with open(photom_name, "r") as photom_file:
 
@@ -309,19 +642,18 @@ def check_sampling_interval(photom_file, Photom_interval, Photom_time_base):
             
     except IOError:
         print(Time_base_error, photom_name, "-->", interval, "ms instead of",Photom_interval, "ms ***\n")
-        exit_on_keypress()                                               # fatal error
+        raise PhautomError(Exit_file)                                               # fatal error
 
  
 #==================================================
-def get_photom_times(photom_name, Photom_time_base, Photom_interval, Photom_skip_header):
+def get_photom_times(photom_name, cfg):
     """
     read photometry file line-by-line to detect TTL markers 
     build a list of TTL onsets
     Parameters
     -----------
        photom_name: full name of file
-       Photom_time_base: in milliseconds
-       Photom_header_size
+       cfg: Config, uses Photom_interval and Photom_marker
     Returns
     -------
         photom_times: a list of times in milliseconds
@@ -330,7 +662,7 @@ def get_photom_times(photom_name, Photom_time_base, Photom_interval, Photom_skip
     
     try:
         with open(photom_name, "r") as photom_file:
-            check_sampling_interval(photom_file, Photom_interval, Photom_time_base)
+            check_sampling_interval(photom_name, cfg.Photom_interval, Photom_time_base)
             
             for i in range(Photom_skip_header+1):              # ignore header and titles
                 photom_line=photom_file.readline() 
@@ -340,7 +672,7 @@ def get_photom_times(photom_name, Photom_time_base, Photom_interval, Photom_skip
                 valid_line=photom_file.readline()                   # read one line 
                 photom_line=valid_line.split(",")                    # split line
                 if len(photom_line)>Photom_marker_column:
-                    if photom_line[Photom_marker_column].endswith(Photom_marker):
+                    if photom_line[Photom_marker_column].endswith(cfg.Photom_marker):
                         time=float(photom_line[0])*Photom_time_base
                         photom_times+=[time]                             # extract TTL marker
 
@@ -350,91 +682,160 @@ def get_photom_times(photom_name, Photom_time_base, Photom_interval, Photom_skip
     return photom_times
 
 #==================================================
-def get_photom_data(region, photom_name, Photom_time_base, Photom_skip_header):
+def get_photom_data(regions, photom_name, Photom_time_base, Photom_skip_header, dtype=float):
     """
-    read photometry file 
+    read photometry file once for all regions
     Parameters
     -----------
-       region: 1 or 2 
+       regions: list of regions (1, 2)
        photom_name: full name of file
        Photom_time_base: in milliseconds
        Photom_skip_header: lines to skip before column titles
+       dtype: type of control and signal columns (float or np.float32)
     Returns
     -------
-        df: a pandas dataframe
+        df: a pandas dataframe with timestamps, control and signal of regions only
     """
+    columns=sorted(set().union(*[Photom_columns[region] for region in regions]))
+    dtypes={name: dtype for region in regions for name in (Iso[region], Sig[region])}
     try:
-        if region==1:
-            my_data = pd.read_csv(photom_name, usecols=Use_columns[1], skiprows=Photom_skip_header)
-        elif region==2:
-            my_data = pd.read_csv(photom_name, usecols=Use_columns[2], skiprows=Photom_skip_header)
-        df = pd.DataFrame(my_data)
+        df = pd.read_csv(photom_name, usecols=columns, skiprows=Photom_skip_header, dtype=dtypes)
         # convert all times to milliseconds
         if Photom_time_base!=1: df[Timestamp]=df[Timestamp]*Photom_time_base
         
     except IOError:
         print(File_error, photom_name,"***\n")
+        raise PhautomError(Exit_file)
 
     return df
 
 #==================================================        
-def read_behav_file(behav_name, Behav_header_size):
+def read_behav_cache(cache_name, stamp):
+    """
+    read a behavior sheet stored by write_behav_cache
+    Parameters
+    -----------
+        cache_name: full name of cache file
+        stamp: modification time, size and sheet of the behavior file
+    Returns
+    -------
+        a Pandas dataframe, None if cache is missing or stale
+    """
+    try:
+        with np.load(cache_name) as cache:
+            if str(cache["stamp"])!=stamp: return None
+            columns=[str(title) for title in cache["columns"]]
+            data={}
+            for i, column in enumerate(columns):
+                values=cache["c%d" % i]
+                if "n%d" % i in cache:                                          # text column
+                    values=values.astype(object)
+                    values[cache["n%d" % i]]=np.nan
+                data[column]=values
+    except (IOError, ValueError, KeyError):
+        return None
+    return pd.DataFrame(data, columns=columns)
+
+#==================================================
+def write_behav_cache(cache_name, stamp, behav_lines):
+    """
+    store a behavior sheet as one numpy array per column, text as fixed width unicode with a mask of empty cells
+    sheets with non text titles or with mixed types in a column are not cached
+    Parameters
+    -----------
+        cache_name: full name of cache file
+        stamp: modification time, size and sheet of the behavior file
+        behav_lines: a Pandas dataframe as read from the behavior file
+    """
+    if not all(isinstance(title, str) for title in behav_lines.columns): return
+    arrays={"stamp": np.array(stamp), "columns": np.array(behav_lines.columns, dtype=str)}
+    for i, column in enumerate(behav_lines.columns):
+        values=behav_lines[column]
+        if isinstance(values.dtype, np.dtype) and values.dtype.kind in "biufcmM":     # numbers and dates
+            arrays["c%d" % i]=values.to_numpy()
+        else:
+            missing=values.isna().to_numpy()
+            if not all(isinstance(value, str) for value in values[~missing]): return
+            arrays["n%d" % i]=missing
+            arrays["c%d" % i]=np.array(values.where(~missing, "").tolist(), dtype=str)
+    try:
+        make_subdir(os.path.dirname(cache_name))
+        temp_name=cache_name+".tmp"+str(os.getpid())
+        with open(temp_name, "wb") as cache_file:
+            np.savez(cache_file, **arrays)
+        os.replace(temp_name, cache_name)
+    except IOError:
+        print(File_error, cache_name, "***")                             # not fatal, sheet will be parsed again
+
+#==================================================
+def read_behav_file(behav_name, Behav_time, cache_dir=None):
     """
     read behavioral data from .xlsx file (processed data)
     results include event identity and timestamp
     convert times to milliseconds
+    parsed sheets are cached in cache_dir, keyed by file name, modification time, size, sheet and header size
+    Behav_header_size lines are ignored before column titles
+    all columns are read, since they are all copied to the behavior database
     Parameters
     -----------
        behav_name: full name of file
+       Behav_time: time base of file in milliseconds
+       cache_dir: directory of cached sheets, default no cache
     Returns
     -------
         behav_lines: a Pandas dataframe with timestamps and event_name columns
     """
     try:
-            if Behav_ext==Behav_ext_WhandA:                              # WhandA analyzed file
-                behav_lines = pd.read_csv(behav_name, sep="\t", header=None, skiprows=1)
-                with open(behav_name, "r") as behav_file:
-                    titles=behav_file.readline()
-                    behav_lines.columns = titles.split('\t')
-            else:            
-                xls = pd.ExcelFile(behav_name)
-                behav_lines = pd.read_excel(xls, Sheet_name)             # pandas data frame
+            if os.path.splitext(behav_name)[1]==Behav_ext_WhandA:     # WhandA analyzed file
+                behav_lines = pd.read_csv(behav_name, sep="\t", skiprows=Behav_header_size)
+            else:
+                behav_lines=None
+                if cache_dir:
+                    status=os.stat(behav_name)
+                    stamp="%d %d %s %d" % (status.st_mtime_ns, status.st_size, Sheet_name, Behav_header_size)
+                    cache_name=os.path.join(cache_dir, hashlib.sha1(os.path.abspath(behav_name).encode()).hexdigest()+Behav_cache_ext)
+                    behav_lines=read_behav_cache(cache_name, stamp)
+                if behav_lines is None:
+                    behav_lines = pd.read_excel(behav_name, sheet_name=Sheet_name, skiprows=Behav_header_size)     # streamed by openpyxl in read only mode
+                    if cache_dir: write_behav_cache(cache_name, stamp, behav_lines)
 
             # convert times to milliseconds
             behav_lines[Time_column]=behav_lines[Time_column]*Behav_time
             
     except IOError:
         print(File_error, behav_name,"***\n")
-        exit_on_keypress()                                                                      # fatal error
+        raise PhautomError(Exit_file)                                                                      # fatal error
 
     return behav_lines
 
 #==================================================
-def get_behav_times(behav_lines, Behav_time_unit):
+def get_behav_times(behav_lines, cfg):
     """
     compute a list of event times from behav file
     Parameters
     -----------
        behav_lines: a Pandas dataframe with timstamps and event_codes columns
-       Behav_time_unit: in milliseconds
+       cfg: Config, uses TTL_on, Synchro_codes and Add_reward, checks columns of anchors
     Returns
     -------
         time_list: in milliseconds
     """
     time_list=[]
+    TTL_on, Synchro_codes = cfg.TTL_on, cfg.Synchro_codes
     if TTL_on and not TTL_on in behav_lines.columns:
         print("\n*** Missing column:", TTL_on,"***")
-        exit_on_keypress()
-    if Align_on and not Align_on in behav_lines.columns:
-        print("\n*** Missing column:", Align_on,"***")
-        exit_on_keypress()
+        raise PhautomError(Exit_parameter)
+    for column, minus, plus in cfg.anchors:
+        if column and not column in behav_lines.columns:
+            print("\n*** Missing column:", column,"***")
+            raise PhautomError(Exit_parameter)
 
     for index, line in behav_lines.iterrows():
         time, event = line[Time_column], line[Event_column]
         if not isinstance(event, str):
             print("\nAnomaly line", index+1,": event is not a string")
             print("Please check content of behavioral event file (.xlsx)")
-            exit_on_keypress()
+            raise PhautomError(Exit_file)
         event_code=event[Event_code_size:]
         if TTL_on:
             time+=line[TTL_on]*Behav_time_unit
@@ -444,7 +845,7 @@ def get_behav_times(behav_lines, Behav_time_unit):
             for TTL in Synchro_codes[event_code]:
                 time_list+=[time+TTL]
 
-        if Add_reward and Reward_column in behav_lines.columns and line[Reward_column]==1:                 # add reward
+        if cfg.Add_reward and Reward_column in behav_lines.columns and line[Reward_column]==1:         # add reward
             event_code="D1"
             for TTL in Synchro_codes[event_code]:
                 time_list+=[time+TTL]
@@ -590,8 +991,95 @@ def align(li1, li2, span, start, end):
     if best[1]==0: return None, 0, None, None, None
     return *best, size
 
+#==================================================
+def match_nearest(times, targets, span):
+    """
+    match each target with the nearest of sorted times
+    Parameters
+    -----------
+        times: sorted array of times, in milliseconds
+        targets: array of times, in milliseconds
+        span: allowed error for matching, in milliseconds
+    Returns
+    -------
+        matched: boolean array, True for targets within span of a time
+        errors: array of errors times - targets for each target
+        nearest: array of indices of nearest times
+    """
+    j=np.clip(np.searchsorted(times, targets), 1, len(times)-1)
+    lower, upper = times[j-1]-targets, times[j]-targets
+    is_lower=np.abs(lower)<=np.abs(upper)
+    errors=np.where(is_lower, lower, upper)
+    return np.abs(errors)<=span, errors, j-is_lower
+
+#==================================================
+def align_drift(li1, li2, span, start, end, max_drift):
+    """
+    blind alignment between behav_times and photom_times allowing for a clock drift
+    photometry time = dt + (1+drift) * behavior time
+    first, each pair of behavior and photometry times whose difference lies within [start, end]
+    votes for the offsets it implies under each drift (Hough-like search, drift step keeps
+    the error over the session below 'span'); the fullest cell gives a first dt and drift
+    then dt and drift are fitted by least squares on nearest matches within span
+    cost: sorting and searchsorted O(n log n), plus one bincount over pairs for each drift step
+    Parameters
+    -----------
+        li1, li2: lists of behav_times and photom_times, in milliseconds
+        span: allowed error for matching, in milliseconds
+        start, end: range of offsets photom_times - behav_times explored, in milliseconds
+        max_drift: largest drift expected, in parts per million
+    Returns
+    -------
+        dt: offset photom_times - behav_times at behavior time 0
+        drift: relative clock drift (photometry/behavior - 1)
+        matches: number of matches within span
+        fit: sum of absolute fitting errors for matches only
+        bias: sum of relative fitting errors for matches only
+        size: number of events in shorter list
+    """
+    behav, photom = np.sort(np.asarray(li1, dtype=float)), np.sort(np.asarray(li2, dtype=float))
+    size=min(len(behav), len(photom))
+    if len(behav)<2 or len(photom)<2: return None, 0.0, 0, None, None, size
+    margin=span+max_drift*1e-6*np.abs(behav).max()                 # largest effect of drift on differences
+
+    # pairwise differences photom - behav within offset range
+    low=np.searchsorted(photom, behav+start-margin)
+    high=np.searchsorted(photom, behav+end+margin, side='right')
+    counts=high-low
+    pairs=np.repeat(np.arange(len(behav)), counts)                    # behav index of each pair
+    first=np.repeat(low-np.cumsum(counts)+counts, counts)
+    differences=photom[first+np.arange(counts.sum())]-behav[pairs]
+    if not len(differences): return None, 0.0, 0, None, None, size
+
+    # vote for (drift, dt) cells, dt bins of width span
+    step=min(span/max(behav[-1]-behav[0], 1)*1e6, max_drift) if max_drift else 1   # drift step in ppm
+    drifts=np.arange(-max_drift, max_drift+step/2, step)*1e-6
+    origin=start-2*margin
+    nb_bins=int((end-start+4*margin)/span)+2
+    best_votes=0
+    for drift in drifts:
+        bins=((differences-drift*behav[pairs]-origin)/span).astype(int)
+        votes=np.bincount(bins[(bins>=0) & (bins<nb_bins)], minlength=nb_bins)
+        votes=votes[:-1]+votes[1:]                                            # neighbour bins, peak is not split
+        k=np.argmax(votes)
+        if votes[k]>best_votes:
+            best_votes, best_drift, dt = votes[k], drift, origin+(k+1)*span
+    drift=best_drift
+
+    # refine: least squares fit of photom - behav = dt + drift * behav on matched pairs
+    for i in range(3):
+        matched, errors, nearest = match_nearest(photom, dt+(1+drift)*behav, span)
+        if matched.sum()<2: break
+        x=behav[matched]
+        drift, dt = np.polyfit(x, dt+drift*x+errors[matched], 1)    # photom - behav of matched pairs
+
+    matched, errors, nearest = match_nearest(photom, dt+(1+drift)*behav, span)
+    matches=len(np.unique(nearest[matched]))                         # each photometry time matched once
+    if matches==0: return None, 0.0, 0, None, None, size
+    return dt, drift, matches, np.abs(errors[matched]).sum(), errors[matched].sum(), size
+
 #===================================================== 
-def make_log(summary_name, log_filename, behav_times, photom_times, offset, fitstring):
+def make_log(summary_name, log_filename, behav_times, photom_times, offset, fitstring, drift=0.0):
     """
     create a file with all matched event times
     append fit info to global log file
@@ -603,6 +1091,7 @@ def make_log(summary_name, log_filename, behav_times, photom_times, offset, fits
         photom_times: list of pulse codes read from photom file
         offset: in ms to be added to behav_times
         fitstring: text info about goodness of fit
+        drift: relative clock drift, behav_times are converted to offset + (1+drift) * behav_time
     Returns
     -------
         creates a .csv file (delimiter ; ) with 6 columns
@@ -614,52 +1103,180 @@ def make_log(summary_name, log_filename, behav_times, photom_times, offset, fits
             line=log_filename+"\noffset: "+'{o: .3f}'.format(o=offset/1000)+"\n"+fitstring+"\n"
             log_file.write(line)
 
-        # detailed log file            
+        behav, photom = np.asarray(behav_times, dtype=float), np.asarray(photom_times, dtype=float)
+        missing=np.flatnonzero(np.isnan(behav))
+        if len(missing):
+            n=missing[0]
+            print('Error: missing time after', int(behav[n-1]) if n else 0, 'ms')
+            raise PhautomError(Exit_file)
+
+        # convert behavioral times to photometry times
+        b2p_times=offset+(1+drift)*behav
+        # find lower and higher surrounding photometry times (search never goes back, as in a sequential scan)
+        high=np.maximum.accumulate(np.minimum(np.searchsorted(photom, b2p_times), len(photom)-1))
+        lo_times, hi_times = photom[np.maximum(high-1, 0)], photom[high]
+        lower, upper = np.trunc(b2p_times-lo_times), np.trunc(hi_times-b2p_times)
+        errors=np.where(lower<upper, lower, -upper).astype(int)
+        no_match=np.where(hi_times<b2p_times, "; no match", "")
+
+        # detailed log file, written at once
+        line=log_filename+"\noffset: "+'{o: .3f}'.format(o=offset/1000)+"\n"+fitstring+"\n"   # title line
+        line+="event\tbehav_t\talign_t\tlow_phot_t\thigh_phot_t\tmatch (ms)\n"
+        rows=zip(range(1, len(behav)+1), (behav/1000).tolist(), (b2p_times/1000).tolist(),
+                 (lo_times/1000).tolist(), (hi_times/1000).tolist(), errors.tolist(), no_match.tolist())
+        line+=''.join(['% d\t% .1f\t% .3f\t% .3f\t%.3f\t% d%s\n' % row for row in rows])
         with open(log_filename, "w") as log_file:
-            # title line
-            line=log_filename+"\noffset: "+'{o: .3f}'.format(o=offset/1000)+"\n"+fitstring+"\n"
             log_file.write(line)
-            log_file.write("event\tbehav_t\talign_t\tlow_phot_t\thigh_phot_t\tmatch (ms)\n")
-            i=0
-            lo_time=photom_times[i]
-            hi_time=photom_times[i]
-            for n, b_time in enumerate(behav_times):
-                if np.isnan(b_time):
-                    print('Error: missing time after', int((b2p_time-offset)/Behav_time))
-                    exit_on_keypress()
-                # convert behavioral time to photometry time
-                b2p_time=b_time+offset
-                # find lower (pt) and higher (npt) surrounding photometry times
-                while photom_times[i]<b2p_time and i<len(photom_times)-1:
-                    lo_time=photom_times[i]
-                    i+=1
-                    hi_time=photom_times[i]
-                err=int(b2p_time-lo_time) if int(b2p_time-lo_time) < int(hi_time-b2p_time) else int(b2p_time-hi_time)
-                
-                line='{l: 0}\t{bt: .1f}\t{bpt: .3f}\t{lpt: .3f}\t{hpt:.3f}\t{x: 0}'.format(
-                            l=n+1, bt=b_time/1000, bpt=b2p_time/1000, lpt=lo_time/1000, hpt=hi_time/1000, \
-                            x=err)
-                if hi_time<b2p_time: line+="; no match"
-                log_file.write(line+"\n")
             
     except IOError:
         print(File_error, log_filename," file may be open ***\n")
-        exit_on_keypress()
+        raise PhautomError(Exit_file)
 
 #==================================================
-def export_behav(photom_name, Behav_database_name, behav_lines, Behav_time, offset, min_t, max_t):
+def get_trial_times(behav_lines, offset, min_t, max_t, cfg, drift=0.0):
     """
     use offset to convert trials from behavioral file to photometry times
-    only trials within photometry time range are stored
-    append to Behav_database file
+    only trials within photometry time range are kept
     Parameters
     -----------
-        photom_name: string, photometry filename (short)
-        Behav_database_name: string, global
-        behav_lines: list of lines or data frame read from behavior file
-        Behav_time: float, global
+        behav_lines: data frame read from behavior file
         offset: float (ms) from behavior to photometry
         min_t, max_t: time limits of photometry
+        cfg: Config, uses Align_on, Minus_window and Plus_window
+        drift: relative clock drift, see align_drift
+    Returns
+    -------
+        times: array of trial times in photometry time frame, one per line of behav_lines
+        keep: boolean array, True for trials within photometry time range
+    """
+    times = behav_lines[Time_column].to_numpy(dtype=float)
+    if cfg.Align_on:
+        times = times + behav_lines[cfg.Align_on].to_numpy(dtype=float)*Behav_time_unit   # alignment on an event
+    times = offset + times if not drift else offset + (1+drift)*times                    # convert time
+    keep = (times > min_t - cfg.Minus_window) & (times < max_t - cfg.Plus_window)
+    return times, keep
+
+#==================================================
+def database_is_empty(filename):
+    """
+    True if database does not exist yet or is empty: title line needed
+    """
+    return not os.path.isfile(filename) or os.path.getsize(filename)==0
+
+#==================================================
+def database_titles(filename):
+    """
+    title line of an existing database, without new line (decompressed if .gz or .xz)
+    """
+    ext=os.path.splitext(filename)[1]
+    if ext==Compression_ext["gzip"]:
+        import gzip
+        opener=gzip.open
+    elif ext==Compression_ext["lzma"]:
+        import lzma
+        opener=lzma.open
+    else: opener=open
+    with opener(filename, "rt") as database_file:
+        return database_file.readline().rstrip("\n")
+
+#==================================================
+def check_titles(filename, titles):
+    """
+    stop before appending to a database whose columns differ from those of the session
+    (options adding columns changed since database was created)
+    Parameters
+    -----------
+        filename: string, full name of database
+        titles: title line of session, see behav_titles and photom_titles
+    """
+    if database_is_empty(filename): return
+    try: old_titles=database_titles(filename)
+    except IOError:
+        print(File_error, filename," file may be open ***\n")
+        raise PhautomError(Exit_file)
+    if old_titles!=titles:
+        print("\n*** Error: columns of", os.path.basename(filename), "differ from those of session ***")
+        print("Database:", old_titles.replace('\t', ' '))
+        print("Session: ", titles.replace('\t', ' '))
+        print("Options changed since database was created, please use another output directory")
+        raise PhautomError(Exit_parameter)
+
+#==================================================
+def behav_titles(behav_lines, artifacts=False, transients=False, groups=False):
+    """
+    title line of behavior database, without new line:
+    columns of behavior file, seance if Session_info, optional columns of export_behav and check code
+    """
+    titles=list(behav_lines.columns)
+    if Session_info and not "seance" in behav_lines.columns: titles.append("seance")
+    if artifacts: titles.append("artifact")
+    if transients: titles.append("transients")
+    if groups: titles+=["animal", "cohort"]
+    return '\t'.join(titles+["check"])
+
+#==================================================
+def photom_titles(cfg):
+    """
+    title line of photometry database, without new line:
+    trial columns, z parameters (see z_parameters) and times of epoch samples
+    """
+    z_titles=(["bl_mean", "bl_stdev"] if cfg.Baseline_window else [])+(["roll_mean", "roll_stdev"] if cfg.Rolling_window else [])
+    return '\t'.join(["time", "check", "mean", "stdev", "gain", "shift"]+z_titles+[str(i) for i in epoch_titles(cfg)])
+
+#==================================================
+def open_database(filename):
+    """
+    open database for appending text
+    .gz and .xz databases are written through a streaming compressor:
+    each session appends a gzip member or an xz stream, read back as a single text
+    Parameters
+    -----------
+        filename: string, full name of database
+    Returns
+    -------
+        a text file object
+    """
+    ext=os.path.splitext(filename)[1]
+    if ext==Compression_ext["gzip"]:
+        import gzip                                                          # compressors loaded only when used
+        return gzip.open(filename, "at", compresslevel=Gzip_level)
+    if ext==Compression_ext["lzma"]:
+        import lzma
+        return lzma.open(filename, "at")
+    return open(filename, "a")
+
+#==================================================
+def write_offsets(Photom_database_name, offsets, empty):
+    """
+    append byte offsets and check codes of new rows to sidecar index of photometry database (int64 pairs)
+    sidecar is restarted with a new database, and left to phanal to build if database predates it
+    Parameters
+    -----------
+        Photom_database_name: string, full name of plain text database
+        offsets: a list of (byte offset, check code), one per row written
+        empty: True if database was created with these rows
+    """
+    offsets_name=Photom_database_name+Offsets_ext
+    if not empty and not os.path.isfile(offsets_name): return
+    try:
+        with open(offsets_name, "wb" if empty else "ab") as offsets_file:
+            offsets_file.write(np.asarray(offsets, dtype=np.int64).reshape(-1, 2).tobytes())
+    except IOError:
+        print(File_error, offsets_name, "***")                               # not fatal, rebuilt by phanal
+
+#==================================================
+def export_behav(photom_name, Behav_database_name, behav_lines, times, keep, artifacts=None, transients=None, groups=None):
+    """
+    append trials within photometry time range to Behav_database file
+    Parameters
+    -----------
+        photom_name: string, photometry filename (short)
+        Behav_database_name: string, full name of database
+        behav_lines: list of lines or data frame read from behavior file
+        times, keep: trial times and selection, see get_trial_times
+        artifacts: optional, fraction of glitch samples of each trial, see artifact_fractions
+        transients: optional, number of transients of each trial, see transient_counts
+        groups: optional, (animal, cohort) of session, see session_groups
     Returns
     -------
         append trial info to Behav_database file
@@ -667,189 +1284,695 @@ def export_behav(photom_name, Behav_database_name, behav_lines, Behav_time, offs
     """
     trial_times=[]
     try:
-        with open(Behav_database_name, 'a') as behav_file:
+        empty=database_is_empty(Behav_database_name)
+        with open_database(Behav_database_name) as behav_file:
             # compute session from name
             if Session_info:
                 session=os.path.split(photom_name)[-1][Session_info[0]:Session_info[1]]
             
             # write title line
-            if os.path.getsize(Behav_database_name) == 0:                 # if file is empty
-                if Session_info and not "seance" in behav_lines.columns:
-                    behav_file.write('\t'.join(list(behav_lines.columns))+"\tseance\tcheck\n")
-                else:
-                    behav_file.write('\t'.join(list(behav_lines.columns))+"\tcheck\n")
+            if empty:
+                behav_file.write(behav_titles(behav_lines, artifacts is not None, transients is not None, groups is not None)+"\n")
 
             # write trial lines        
-            for index, line in behav_lines.iterrows():
+            if artifacts is None: artifacts=[None]*len(times)
+            if transients is None: transients=[None]*len(times)
+            for (index, line), time, ok, artifact, count in zip(behav_lines.iterrows(), times, keep, artifacts, transients):
+                if not ok: continue
                 if Session_info:
                      line["seance"]=session
-                time = offset + line[Time_column]                                   # convert time
-                if Align_on:
-                    time+= line[Align_on]*Behav_time_unit               # alignment on an event
                 check_code = str(int(random()*100_000))               # to verify match of Photom_database with Behav_database
-                if time > min_t - Minus_window and time < max_t - Plus_window:
-                    trial_times.append((time, check_code))                # memorize trial times
-                    line_string='\t'.join([str(x) for x in line])
-                    behav_file.write(line_string+'\t'+check_code+'\n')
+                trial_times.append((time, check_code))                    # memorize trial times
+                line_string='\t'.join([str(x) for x in line])
+                if artifact is not None: line_string+='\t'+str(round(artifact, 4))
+                if count is not None: line_string+='\t'+str(count)
+                if groups is not None: line_string+='\t'+'\t'.join(groups)
+                behav_file.write(line_string+'\t'+check_code+'\n')
 
     except IOError:
-        print(File_error, log_filename," file may be open ***\n")
-        exit_on_keypress()
+        print(File_error, Behav_database_name," file may be open ***\n")
+        raise PhautomError(Exit_file)
     return trial_times
 
 #==================================================
-def plot(title, x, y, z=None, yname='', zname=''):
-    global Visualize
-    if Visualize:
-        graph.plot(x, y, label=yname)
-        if z is not None:
-            graph.plot(x, z, label=zname)
-        fig = graph.gcf()
-        fig.canvas.manager.set_window_title(title)
-        if yname or zname: graph.legend()
-        graph.show()
-        try: 
-            print("\n*** Press Ctrl-C during pause to quit ***\n     Database will not be modified !")
-            time.sleep(Pause_time)
-        except:
-            os._exit(1)
-    
+def envelope(x, ys, points=Plot_points):
+    """
+    min/max envelope of traces, for fast drawing of long sessions
+    each bucket of samples is replaced by its minimum and maximum, so that peaks remain visible
+    Parameters
+    -----------
+        x: array of times
+        ys: list of arrays of same length as x
+        points: most points kept per trace
+    Returns
+    -------
+        x, ys: decimated
+    """
+    x=np.asarray(x)
+    width=-(-2*len(x)//points)                                          # samples per bucket, 2 points per bucket
+    if width<=2: return x, [np.asarray(y) for y in ys]
+    starts=np.arange(0, len(x), width)
+    envelopes=[np.column_stack((np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts))).ravel()
+                        for y in map(np.asarray, ys)]
+    return np.repeat(x[starts], 2), envelopes
+
+#==================================================
+def qc_panels(region, tim, signal, iso, control, delta_f, delta_f_f, cfg):
+    """
+    decimated traces of one region for quality control
+    Parameters
+    -----------
+        region: 1 or 2
+        tim, signal, iso, control, delta_f, delta_f_f: arrays over whole session, see normalize
+        cfg: Config, uses Linear_regression
+    Returns
+    -------
+        panels: a list of (title, x, ys, labels), at most Plot_points per trace
+    """
+    panels=[("Signal/Iso Channel "+str(region), (signal, iso), ('signal', 'iso'))]
+    if cfg.Linear_regression:
+        panels.append(("Fitted control Channel "+str(region), (signal, control), ('signal', 'fitted iso')))
+    panels.append(("deltaF Channel "+str(region), (delta_f, delta_f_f), ('deltaF', 'DeltaF/F')))
+    return [(title, *envelope(tim, ys), labels) for title, ys, labels in panels]
+
+#==================================================
+def draw_panels(fig, panels):
+    """
+    draw panels one below the other in a matplotlib figure
+    """
+    axes=fig.subplots(len(panels), 1, sharex=True, squeeze=False)[:, 0]
+    for ax, (title, x, ys, labels) in zip(axes, panels):
+        for y, label in zip(ys, labels):
+            ax.plot(x, y, label=label, linewidth=0.5)
+        ax.set_title(title, fontsize="small")
+        ax.legend(loc="upper right", fontsize="small")
+    axes[-1].set_xlabel("time (ms)")
+
+#==================================================
+def store_rows(behav_lines, keep, artifacts=None, transients=None, groups=None):
+    """
+    behavior lines of kept trials as text, as in behavior database (see export_behav)
+    """
+    rows=behav_lines[keep].astype(str)
+    if artifacts is not None: rows["artifact"]=[str(round(a, 4)) for a in artifacts[keep]]
+    if transients is not None: rows["transients"]=[str(count) for count in transients[keep]]
+    if groups is not None: rows["animal"], rows["cohort"] = groups
+    return rows
+
+#==================================================
+def quote(name):
+    """
+    column name as an SQL identifier
+    """
+    return '"'+name.replace('"', '""')+'"'
+
+#==================================================
+def add_columns(connection, table, names, kind):
+    """
+    add missing columns to a table of trial store
+    """
+    existing=[line[1] for line in connection.execute("PRAGMA table_info("+table+")")]
+    for name in names:
+        if not name in existing: connection.execute("ALTER TABLE "+table+" ADD COLUMN "+quote(name)+" "+kind)
+
+#==================================================
+def write_store(store_name, session, regions_data, cfg):
+    """
+    replace trials of a session in SQLite trial store, all regions in a single transaction:
+    a session is stored entirely or not at all, trials and epochs share their id (no check code)
+    tables: trials (id, session, region, behavior columns as text),
+            epochs (id, time, mean, stdev, gain, shift, z parameters, samples as float32 blob)
+    Parameters
+    -----------
+        store_name: full name of trial store
+        session: session name
+        regions_data: a list of (region key, behavior rows, see store_rows, (columns, epochs), see export_epochs)
+        cfg: Config, titles of samples must be the same for all sessions
+    Returns
+    -------
+        writes to trial store
+    """
+    import sqlite3                                                           # loaded only with Storage sqlite
+    titles='\t'.join(str(i) for i in epoch_titles(cfg))
+    connection=None
+    try:
+        connection=sqlite3.connect(store_name)
+        with connection:                                                                 # one transaction, rolled back on error
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS trials (id INTEGER PRIMARY KEY, session TEXT, region INTEGER)")
+            connection.execute("CREATE INDEX IF NOT EXISTS trials_session ON trials (session, region)")
+            connection.execute("CREATE TABLE IF NOT EXISTS epochs (id INTEGER PRIMARY KEY REFERENCES trials (id))")
+            stored=dict(connection.execute("SELECT key, value FROM meta")).get("epoch_titles", titles)
+            if stored!=titles:
+                print("\n*** Error: epoch times differ from those of trial store", store_name, "***")
+                print("Check Minus_window, Plus_window and Output_interval")
+                raise PhautomError(Exit_parameter)
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('epoch_titles', ?)", (titles,))
+
+            for key, rows, (columns, epochs) in regions_data:
+                behav_columns=[c for c in rows.columns if not c in ("id", "session", "region")]
+                photom_columns=[title for title, column in columns]
+                add_columns(connection, "trials", behav_columns, "TEXT")
+                add_columns(connection, "epochs", photom_columns, "REAL")
+                add_columns(connection, "epochs", ["samples"], "BLOB")
+                connection.execute("DELETE FROM epochs WHERE id IN (SELECT id FROM trials WHERE session=? AND region=?)", (session, key))
+                connection.execute("DELETE FROM trials WHERE session=? AND region=?", (session, key))
+
+                insert_trial="INSERT INTO trials (session, region, "+", ".join(map(quote, behav_columns))+") VALUES (?, ?"+", ?"*len(behav_columns)+")"
+                insert_epoch="INSERT INTO epochs (id, "+", ".join(map(quote, photom_columns))+", samples) VALUES (?"+", ?"*len(photom_columns)+", ?)"
+                values=np.column_stack([column for title, column in columns]).tolist() if len(epochs) else []
+                for line, value, samples in zip(rows[behav_columns].itertuples(index=False), values, epochs):
+                    trial_id=connection.execute(insert_trial, (session, key, *line)).lastrowid
+                    connection.execute(insert_epoch, (trial_id, *value, samples.astype(np.float32).tobytes()))
+
+    except sqlite3.Error as error:
+        print(File_error, store_name, "***\n", error)
+        raise PhautomError(Exit_file)
+    finally:
+        if connection: connection.close()
+
+#==================================================
+def plot(title, panels):
+    """
+    show panels in a window, one window per title updated at each session, without blocking
+    """
+    import pylab as graph                                           # matplotlib loaded only when plotting
+    fig=graph.figure(title)
+    fig.clear()
+    draw_panels(fig, panels)
+    graph.show(block=False)
+    try: 
+        print("\n*** Press Ctrl-C during pause to quit ***\n     Database will not be modified !")
+        graph.pause(Pause_time)
+    except KeyboardInterrupt:
+        os._exit(1)
+
+#==================================================
+def render_qc(png_name, title, panels):
+    """
+    save panels as a png file, headless: no window, no pyplot, may run in a worker process
+    """
+    from matplotlib.figure import Figure                  # rendered with Agg, the default of Figure.savefig
+    fig=Figure(figsize=(12, 2.5*len(panels)))
+    fig.suptitle(title)
+    draw_panels(fig, panels)
+    try:
+        fig.savefig(png_name, dpi=100)
+    except IOError:
+        print(File_error, png_name,"***\n")
+
 #==================================================
 def detrend(signal):
     """
     compute global linear trend and remove it without changing DC level
     Parameters
     -----------
-        signal: a pandas dataframe column
+        signal: an array
     Returns
     -------
         signal
     """
     x = np.arange(len(signal))
-    y = signal.values
+    y = np.asarray(signal)
     coeffs = np.polyfit(x, y, deg=1)
     coeffs[1]=0.0
-    trend = np.polyval(coeffs, x)
+    trend = np.polyval(coeffs, x).astype(y.dtype, copy=False)
     return signal-trend
 
 #==================================================
-def compute_delta_f(signal, control):
+def rolling_median(x, width, step):
+    """
+    rolling median over 'width' samples centered on each sample
+    medians are taken every 'step' samples on strided windows (sliding_window_view, no copy)
+    and interpolated in between, about Median_chunk samples at a time for long recordings
+    Parameters
+    -----------
+        x: an array
+        width, step: numbers of samples
+    Returns
+    -------
+        an array of same length as x
+    """
+    padded=np.pad(x, (width//2, width-width//2-1), mode="edge")
+    windows=sliding_window_view(padded, width)[::step]                # window k centered on sample k*step
+    chunk=max(Median_chunk//width, 1)
+    medians=np.concatenate([np.median(windows[k:k+chunk], axis=1) for k in range(0, len(windows), chunk)])
+    return np.interp(np.arange(len(x)), np.arange(0, len(x), step), medians)
+
+#==================================================
+def find_glitches(signal, cfg):
+    """
+    detect glitches (motion artifacts, electrical spikes) as samples far from the rolling median
+    Parameters
+    -----------
+        signal: an array over whole session
+        cfg: Config, uses Glitch_window, Glitch_threshold and Photom_interval
+    Returns
+    -------
+        glitches: boolean array, True for glitch samples
+    """
+    x=np.asarray(signal, dtype=float)
+    width=max(cfg.Glitch_window//cfg.Photom_interval, 3)
+    step=max(width//Glitch_steps, 1)
+    deviation=np.abs(x-rolling_median(x, width, step))
+    mad=rolling_median(deviation, width, step)                             # median absolute deviation
+    return deviation>cfg.Glitch_threshold*1.4826*mad
+
+#==================================================
+def interpolate_glitches(tim, signal, glitches):
+    """
+    replace glitch samples by linear interpolation between neighbouring valid samples
+    """
+    if glitches.all() or not glitches.any(): return signal
+    signal=np.array(signal)                                                   # copy, same type
+    signal[glitches]=np.interp(tim[glitches], tim[~glitches], signal[~glitches])
+    return signal
+
+#==================================================
+def artifact_fractions(tim, glitches, times, cfg):
+    """
+    fraction of glitch samples of each trial, from time + Minus_window to time + Plus_window
+    Parameters
+    -----------
+        tim, glitches: arrays over whole session, see find_glitches
+        times: trial times in photometry time frame
+        cfg: Config, uses Minus_window and Plus_window
+    Returns
+    -------
+        an array (trials)
+    """
+    count=np.concatenate(([0], np.cumsum(glitches)))
+    times=np.asarray(times, dtype=float)
+    low=np.searchsorted(tim, times+cfg.Minus_window)
+    high=np.searchsorted(tim, times+cfg.Plus_window, side="right")
+    return (count[high]-count[low])/np.maximum(high-low, 1)
+
+#==================================================
+def find_transients(tim, delta_f_f, cfg):
+    """
+    detect spontaneous transients over whole session, as runs of samples far above the rolling median
+    threshold is Transient_threshold robust stdevs, from the rolling median absolute deviation (MAD)
+    Parameters
+    -----------
+        tim, delta_f_f: arrays over whole session
+        cfg: Config, uses Transient_window, Transient_threshold and Photom_interval
+    Returns
+    -------
+        transients: arrays (transients) of time of peak, amplitude above rolling median and width above threshold (ms)
+    """
+    x=np.asarray(delta_f_f, dtype=float)
+    width=max(cfg.Transient_window//cfg.Photom_interval, 3)
+    step=max(width//Glitch_steps, 1)
+    deviation=x-rolling_median(x, width, step)
+    mad=rolling_median(np.abs(deviation), width, step)
+    above=np.concatenate(([False], deviation>cfg.Transient_threshold*1.4826*mad, [False]))
+    starts, ends = np.flatnonzero(above[1:] & ~above[:-1]), np.flatnonzero(~above[1:] & above[:-1])
+    if not len(starts): return np.empty(0), np.empty(0), np.empty(0)
+
+    # first maximum of each run
+    inside=np.flatnonzero(above[1:-1])
+    run=np.repeat(np.arange(len(starts)), ends-starts)
+    amplitudes=np.maximum.reduceat(deviation[inside], np.concatenate(([0], np.cumsum(ends-starts)[:-1])))
+    tops=inside[deviation[inside]==amplitudes[run]]
+    peaks=tops[np.unique(run[deviation[inside]==amplitudes[run]], return_index=True)[1]]
+    return tim[peaks], amplitudes, (ends-starts)*float(cfg.Photom_interval)
+
+#==================================================
+def transient_counts(transients, times, cfg):
+    """
+    number of transients peaking in each trial, from time + Minus_window to time + Plus_window
+    """
+    peaks=transients[0]
+    times=np.asarray(times, dtype=float)
+    return np.searchsorted(peaks, times+cfg.Plus_window, side="right")-np.searchsorted(peaks, times+cfg.Minus_window)
+
+#==================================================
+def write_transients(transient_name, transients):
+    """
+    write transient table of one session and region (overwrite): time, amplitude, width
+    """
+    try:
+        with open(transient_name, "w") as transient_file:
+            transient_file.write("time\tamplitude\twidth\n")
+            for time, amplitude, width in zip(*[column.tolist() for column in transients]):
+                transient_file.write(str(time)+'\t'+str(amplitude)+'\t'+str(width)+'\n')
+    except IOError:
+        print(File_error, transient_name," file may be open ***\n")
+        raise PhautomError(Exit_file)
+
+#==================================================
+def compute_delta_f(signal, control, cfg):
     """
     compute deltaF/F over whole session
     Divide_by_mean is the same as not dividing, except for scale
     Parameters
     -----------
-        signal: a pandas dataframe column
-        control: a pandas dataframe column
+        signal: an array
+        control: an array
+        cfg: Config, uses Keep_DC_level, Divide_by_mean and Detrend
     Returns
     -------
         delta_f
         delta_f_f
+        arrays of same type as signal (float32 kept)
     """
+    dtype=np.asarray(signal).dtype
     # DC option
-    control_mean=np.array(control).mean()                                   # mean over whole part
+    control_mean=dtype.type(np.array(control).mean())                     # mean over whole part
     centered_control=control-control_mean
     
     # compute deltaF
-    if Keep_DC_level:
+    if cfg.Keep_DC_level:
         delta_f = signal - centered_control
     else:
         delta_f = signal - control
 
     # compute deltaF/F with F mean or F instantaneous
-    if Divide_by_mean:
+    delta_f=np.asarray(delta_f).astype(dtype, copy=False)
+    if cfg.Divide_by_mean:
         delta_f_f = delta_f *100 / control_mean
     else:
         delta_f_f = delta_f  *100 / control
+    delta_f_f=np.asarray(delta_f_f).astype(dtype, copy=False)
 
     # Detrending
-    if Detrend:
+    if cfg.Detrend:
         delta_f_f =detrend(delta_f_f )                                                # remove global linear trend
     
     return delta_f, delta_f_f
 
 #==================================================
-def export_photom(region, Photom_database_name, photom_data, tim, raw_sig, raw_iso, trial_times):
+def fit_control(signal, iso, cfg):
+    """
+    fit isosbestic control to signal, control = gain * iso + shift
+    global fit, or piecewise over Regression_window centered on each sample
+    weighted sums of iso, signal and their products are cumulated once per pass:
+    any window is then fitted in O(1), whatever the number of windows
+    Robust_regression: Huber weights updated by iteratively reweighted least squares (IRLS)
+    Parameters
+    -----------
+        signal, iso: arrays
+        cfg: Config, uses Robust_regression, Regression_window and Photom_interval
+    Returns
+    -------
+        gain, shift: arrays over whole session, or of size 1 if global fit
+    """
+    x=np.asarray(iso, dtype=float)
+    y=np.asarray(signal, dtype=float)
+    x_mean, y_mean = x.mean(), y.mean()                                     # centered: limits rounding errors
+    x, y = x-x_mean, y-y_mean
+    if cfg.Regression_window:
+        width=max(cfg.Regression_window//cfg.Photom_interval, 2)    # samples per window
+        index=np.arange(len(x))
+        low=np.maximum(index-width//2, 0)
+        high=np.minimum(index-width//2+width, len(x))
+    else:
+        low, high = np.array([0]), np.array([len(x)])
+    weights=np.ones(len(x))
+    for iteration in range(IRLS_iterations if cfg.Robust_regression else 1):
+        sums=[np.concatenate(([0.0], np.cumsum(s))) for s in (weights, weights*x, weights*y, weights*x*x, weights*x*y)]
+        sw, sx, sy, sxx, sxy = [cumsum[high]-cumsum[low] for cumsum in sums]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            gain=np.nan_to_num((sw*sxy-sx*sy)/(sw*sxx-sx*sx))        # 0 if iso is constant
+        shift=(sy-gain*sx)/sw
+        if not cfg.Robust_regression: break
+        residuals=np.abs(y-gain*x-shift)
+        scale=Huber_k*1.4826*np.median(residuals)                       # Huber_k robust stdevs (median absolute deviation)
+        if scale==0: break
+        weights=np.minimum(1, scale/np.maximum(residuals, scale))
+    return gain, shift+y_mean-gain*x_mean
+
+#==================================================
+def normalize(signal, iso, cfg):
+    """
+    fit isosbestic control to signal and compute deltaF/F over whole session
+    Parameters
+    -----------
+        signal, iso: arrays
+        cfg: Config, uses Linear_regression, options of fit_control and of compute_delta_f
+    Returns
+    -------
+        control: iso, fitted if Linear_regression
+        linear_fit: coefficients (gain, shift) to fit isosbestic to signal, arrays if piecewise
+        delta_f, delta_f_f: arrays
+    """
+    linear_fit=(1,0)                                                                                # no fit
+    control=iso
+    if cfg.Linear_regression and (cfg.Robust_regression or cfg.Regression_window):
+        linear_fit=fit_control(signal, iso, cfg)
+        control=(linear_fit[0]*iso+linear_fit[1]).astype(np.asarray(iso).dtype, copy=False)
+    elif cfg.Linear_regression:
+        linear_fit=np.polyfit(np.asarray(iso, dtype=float), np.asarray(signal, dtype=float), 1)    # fit in float64
+        control=(linear_fit[0]*iso+linear_fit[1]).astype(np.asarray(iso).dtype, copy=False)
+    delta_f, delta_f_f = compute_delta_f(signal, control, cfg)
+    return control, linear_fit, delta_f, delta_f_f
+
+#==================================================
+def low_pass(signal, cfg):
+    """
+    zero-phase low-pass filter over whole session, cutoff (-3 dB) at Filter_cutoff Hz
+        moving_average: boxcar of 0.443/cutoff s, odd number of samples so that it is centered (see moving_average)
+        gaussian: gaussian kernel of sigma 0.1325/cutoff s, convolved by FFT
+        butterworth: Butterworth gain 1/sqrt(1+(f/cutoff)^(2*Filter_order)) applied by FFT, without phase shift
+    ends are mirrored to limit edge effects of FFT
+    Parameters
+    -----------
+        signal: an array
+        cfg: Config, uses Filter, Filter_cutoff, Filter_order and Photom_interval
+    Returns
+    -------
+        filtered signal, an array of same length and type (float32 kept)
+    """
+    x=np.asarray(signal)
+    dtype=np.float32 if x.dtype==np.float32 else float
+    rate=1000/cfg.Photom_interval                                               # sampling rate in Hz
+    if cfg.Filter=="moving_average":
+        width=2*max(round((0.443*rate/cfg.Filter_cutoff-1)/2), 0)+1               # nearest odd width: no half-sample shift
+        return moving_average(x.astype(dtype, copy=False), width)
+    pad=min(len(x)-1, int(4*rate/cfg.Filter_cutoff))
+    padded=np.pad(x.astype(float), pad, mode="reflect")
+    frequencies=np.fft.rfftfreq(len(padded), d=1/rate)
+    if cfg.Filter=="gaussian":
+        gain=np.exp(-0.5*(2*np.pi*frequencies*0.1325/cfg.Filter_cutoff)**2)
+    else:
+        gain=1/np.sqrt(1+(frequencies/cfg.Filter_cutoff)**(2*cfg.Filter_order))
+    filtered=np.fft.irfft(np.fft.rfft(padded)*gain, n=len(padded))[pad:pad+len(x)]
+    return filtered.astype(dtype, copy=False)
+
+#==================================================
+def filter_string(cfg):
+    """
+    description of low-pass filter for logs, empty if none
+    """
+    if not cfg.Filter: return ""
+    text="Filter: "+cfg.Filter+" {f:g} Hz".format(f=cfg.Filter_cutoff)
+    if cfg.Filter=="butterworth": text+=" order "+str(cfg.Filter_order)
+    return text
+
+#==================================================
+def epoch_titles(cfg):
+    """
+    times of epoch samples relative to trial, in ms
+    """
+    return range(cfg.Minus_window, cfg.Plus_window+cfg.output_interval, cfg.output_interval)
+
+#==================================================
+def moving_average(signal, width):
+    """
+    centered moving average over 'width' samples, from a cumulative sum: O(N) for any width
+    an even width is the mean of the two boxcars shifted by one sample (half weight at both ends), so that it stays centered
+    averages are taken over fewer samples near both ends
+    Parameters
+    -----------
+        signal: an array
+        width: number of samples
+    Returns
+    -------
+        smoothed signal, an array of same length and type (float32 kept, sums in float64)
+    """
+    signal=np.asarray(signal)
+    if signal.dtype!=np.float32: signal=signal.astype(float, copy=False)
+    if width<=1: return signal
+    cumsum=np.concatenate(([0.0], np.cumsum(signal, dtype=float)))
+    index=np.arange(len(signal))
+    averages=0
+    for shift in ((0,) if width%2 else (0, 1)):
+        low=np.maximum(index-width//2+shift, 0)
+        high=np.minimum(index-width//2+shift+width, len(signal))
+        averages=averages+(cumsum[high]-cumsum[low])/(high-low)
+    return (averages/(2-width%2)).astype(signal.dtype, copy=False)
+
+#==================================================
+def extract_epochs(tim, delta_f_f, times, cfg):
+    """
+    cut deltaF/F around each trial, from time + Minus_window to time + Plus_window
+    one sample every Output_interval: delta_f_f should be low-pass filtered first (see moving_average)
+    compute z parameters mean and stdev
+    Parameters
+    -----------
+        tim, delta_f_f: arrays over whole session
+        times: trial times in photometry time frame
+        cfg: Config, uses Minus_window, Plus_window, Output_interval and Globalize_z_score
+    Returns
+    -------
+        epochs: contiguous array (trials, samples), same type as delta_f_f
+        means, stdevs: arrays (trials), over each epoch or over whole session if Globalize_z_score
+    """
+    size=len(epoch_titles(cfg))
+    start=np.searchsorted(tim, np.asarray(times, dtype=float)+cfg.Minus_window)    # first sample of each trial
+    index=np.minimum(start[:, None]+np.arange(size)*cfg.decimation, len(tim)-1)
+    epochs=np.asarray(delta_f_f)[index]
+    if cfg.Globalize_z_score:
+        means=np.full(len(epochs), np.mean(delta_f_f, dtype=float))
+        stdevs=np.full(len(epochs), np.std(delta_f_f, dtype=float, ddof=1))
+    else:
+        means=epochs.mean(axis=1, dtype=float)                         # float64 accumulators
+        stdevs=epochs.std(axis=1, dtype=float, ddof=1)
+    return epochs, means, stdevs
+
+#==================================================
+def rolling_stats(tim, signal, times, width):
+    """
+    mean and stdev of signal over a window of 'width' ms centered on each time
+    from cumulative sums of signal and squared signal: O(N) per session for any number of windows
+    Parameters
+    -----------
+        tim, signal: arrays over whole session
+        times: times of window centers
+        width: in ms
+    Returns
+    -------
+        means, stdevs: arrays (times)
+    """
+    signal=np.asarray(signal, dtype=float)
+    center=np.nanmean(signal)                                           # limits rounding errors of squared sums
+    cumsum=np.concatenate(([0.0], np.cumsum(signal-center)))
+    cumsum2=np.concatenate(([0.0], np.cumsum((signal-center)**2)))
+    times=np.asarray(times, dtype=float)
+    low=np.searchsorted(tim, times-width/2)
+    high=np.searchsorted(tim, times+width/2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        count=high-low
+        sums=cumsum[high]-cumsum[low]
+        means=sums/count
+        stdevs=np.sqrt(np.maximum(cumsum2[high]-cumsum2[low]-sums*means, 0)/(count-1))
+    return means+center, stdevs
+
+#==================================================
+def z_parameters(tim, delta_f_f, times, epochs, cfg):
+    """
+    optional normalization parameters of each trial, stored after mean and stdev of extract_epochs
+    baseline: mean and stdev of epoch over Baseline_window
+    rolling: mean and stdev of session trace over Rolling_window centered on trial
+    Parameters
+    -----------
+        tim, delta_f_f: arrays over whole session
+        times: trial times in photometry time frame
+        epochs: array (trials, samples), see extract_epochs
+        cfg: Config, uses Baseline_window and Rolling_window
+    Returns
+    -------
+        a list of (title, array (trials))
+    """
+    columns=[]
+    if cfg.Baseline_window:
+        titles=np.asarray(epoch_titles(cfg))
+        start, end = np.searchsorted(titles, cfg.Baseline_window[0]), np.searchsorted(titles, cfg.Baseline_window[1], side="right")
+        baseline=epochs[:, start:end]
+        columns+=[("bl_mean", baseline.mean(axis=1, dtype=float)), ("bl_stdev", baseline.std(axis=1, dtype=float, ddof=1))]
+    if cfg.Rolling_window:
+        means, stdevs = rolling_stats(tim, delta_f_f, times, cfg.Rolling_window)
+        columns+=[("roll_mean", means), ("roll_stdev", stdevs)]
+    return columns
+
+#==================================================
+def prepare_photom(region, tim, raw_sig, raw_iso, cfg):
     """
     process and filter data
-    compute deltaF/F, mean and stdev around trials
+    compute deltaF/F once over whole session, shared by epochs of each anchor (see export_epochs) and transients
+    Parameters
+    -----------
+        region: 1 or 2
+        tim, raw_sig, raw_iso: arrays over whole session
+        cfg: Config
+    Returns
+    -------
+        panels: decimated traces for quality control if Visualize or QC_plots, else None
+        linear_fit: gain and shift of control, see normalize
+        delta_f_f: array over whole session, at full resolution (None if Visualize), see export_epochs for decimation
+    """
+    signal, iso = raw_sig, raw_iso
+
+    # linear fit of control to signal, globalized deltaf/F
+    control, linear_fit, delta_f, delta_f_f = normalize(signal, iso, cfg)
+    panels=None
+    if cfg.Visualize or cfg.QC_plots:
+        panels=qc_panels(region, tim, signal, iso, control, delta_f, delta_f_f, cfg)
+    if cfg.Visualize:
+        plot("Channel "+str(region), panels)
+        return panels, linear_fit, None
+
+    # low-pass filter, once over whole session
+    if cfg.Filter: delta_f_f=low_pass(delta_f_f, cfg)
+    return panels, linear_fit, delta_f_f
+
+#==================================================
+def export_epochs(Photom_database_name, tim, delta_f_f, linear_fit, trial_times, cfg):
+    """
+    compute epochs, mean and stdev around trials
     from press + Minus_window to press + Plus_window
     append to Photom_database file
     Parameters
     -----------
-        region: 1 or 2
-        Photom_database_name: string, global
-        tim, raw_sig, raw_iso: columns in a pandas dataframe
+        Photom_database_name: string, full name of database
+        tim, delta_f_f: arrays over whole session, delta_f_f at full resolution
+        linear_fit: gain and shift of control, see normalize
         trial_times: a list of tuples (time, check_code) in photometry time frame
-        linear_fit: coefficients to fit isosbectic to signal
+        cfg: Config of anchor
     Returns
     -------
-        append photometry info to Photom_database file
+        append photometry info to Photom_database file, if Storage is text, and row offsets if not compressed
+        trials: (columns, epochs) for trial store if Storage is sqlite, else None
+            columns: a list of (title, array (trials)), time, mean, stdev, gain, shift and z parameters
     """
-    global Visualize
-    
-    signal, iso = raw_sig, raw_iso
-    plot("Signal/Iso Channel "+str(region), tim, signal, iso, 'signal', 'iso')      # plot raw data if Visualize    
-##    plot("Signal/Glitch Channel "+str(region), tim, raw_sig, signal, 'raw', 'signal')      # plot raw data if Visualize    
-##    plot("Control/Glitch Channel "+str(region), tim, raw_iso, iso, 'raw', 'iso')        # plot raw data if Visualize
+    # trial epochs and z parameters
+    times=[time for time, check_code in trial_times]
+    epochs, means, stdevs = extract_epochs(tim, moving_average(delta_f_f, cfg.decimation), times, cfg)   # anti-aliasing
+    z_columns=z_parameters(tim, delta_f_f, times, epochs, cfg)
+    z_rows=np.column_stack([column for title, column in z_columns]) if z_columns else np.empty((len(epochs), 0))
+    trial_index=np.minimum(np.searchsorted(tim, times), len(tim)-1)
+    gains, shifts = [np.broadcast_to(np.asarray(c), tim.shape)[trial_index] for c in linear_fit]   # per trial if piecewise
+    if cfg.Storage=="sqlite":
+        columns=[("time", np.asarray(times, dtype=float)), ("mean", means), ("stdev", stdevs), ("gain", gains), ("shift", shifts)]
+        return columns+z_columns, epochs
+
+    offsets=[]
+    try:
+         empty=database_is_empty(Photom_database_name)
+         position=0 if empty else os.path.getsize(Photom_database_name)    # byte offset of next row (plain text)
+         with open_database(Photom_database_name) as photom_file:
+            line_size=lambda text: len(text.encode(photom_file.encoding))+len(os.linesep)     # '\n' written as os.linesep
+            # write title line
+            if empty:
+                title_string=photom_titles(cfg)
+                photom_file.write(title_string+"\n")
+                position+=line_size(title_string)
+
+            # write trial data
+            for (time, check_code), mean, stdev, gain, shift, z_row, delff in zip(trial_times, means, stdevs, gains, shifts, z_rows, epochs):
+                line_string='\t'.join([str(time), str(check_code), str(mean), str(stdev), str(gain), str(shift)]
+                                            +[str(x) for x in z_row.tolist()])+'\t'
+                line_string+='\t'.join(delff.astype(str))              # shortest text, float32 or float64
+                if not cfg.Compression:
+                    offsets.append((position, int(check_code)))
+                    position+=line_size(line_string)
+                photom_file.write(line_string+'\n')
+         if not cfg.Compression: write_offsets(Photom_database_name, offsets, empty)
 
-    # linear fit of control to signal
-    linear_fit=(1,0)                                                                                # no fit
-    control=iso
-    if  Linear_regression:
-        linear_fit=np.polyfit(iso, signal, 1)
-        control=linear_fit[0]*iso+linear_fit[1]
-        plot("Fitted control Channel "+str(region), tim, signal, control, 'signal', 'fitted iso')  # plot data if Visualize
-   
-    # globalized deltaf/F
-    delta_f, delta_f_f = compute_delta_f(signal, control)
-    ref=control
-    if Divide_by_mean: ref=np.array(control).mean()
-    plot("deltaF Channel "+str(region), tim, delta_f, delta_f_f, 'deltaF', 'DeltaF/F')  # plot data if Visualize       
-
-    # compute global z parameters mean and stdev
-    mean, stdev = 0, 1
-    if Globalize_z_score:       
-        mean = delta_f_f.mean()
-        stdev = delta_f_f.std()
-        
-    if not Visualize:
-        try:
-             with open(Photom_database_name, 'a') as photom_file:
-                # write title line
-                if os.path.getsize(Photom_database_name) == 0:                 # if file is empty
-                    titles=[str(i) for i in range(Minus_window, Plus_window+Photom_interval, Photom_interval)]
-                    photom_file.write("time\tcheck\tmean\tstdev\tgain\tshift\t"+'\t'.join(titles)+"\n")
-
-                # browse trials
-                nb_colons=0
-                for time, check_code in trial_times:
-                    start_time = time + Minus_window                                        # range around event
-                    end_time = time + Plus_window + Photom_interval
-
-                    # channel slices
-                    period = tim[(tim>=start_time) & (tim<end_time)]           
-                    sig=signal[(tim>=start_time) & (tim<end_time)]
-                    cont=control[(tim>=start_time) & (tim<end_time)]          # fitted if Linear_regression
-                    delff=delta_f_f[(tim>=start_time) & (tim<end_time)]
-
-                    # compute z parameters mean and stdev
-                    if not Globalize_z_score:       
-                        mean = delff.mean()
-                        stdev = delff.std()
-
-                    # write trial data
-                    if not nb_colons: nb_colons=len(delff)                             # OK except if first line is too long
-                    line_string='\t'.join([str(time), str(check_code), str(mean), str(stdev), str(linear_fit[0]), str(linear_fit[1])])+'\t'
-                    if nb_colons<len(delff):                                                       # delete extra colons
-                        delff=delff.iloc[:-1]
-                        print("deleting 1 value at time", time)
-                    line_string+='\t'.join([str(x) for x in delff])
-                    photom_file.write(line_string+'\n')
-
-        except IOError:
-            print(File_error, Photom_database_name," file may be open ***\n")
-            exit_on_keypress()
+    except IOError:
+        print(File_error, Photom_database_name," file may be open ***\n")
+        raise PhautomError(Exit_file)
+    return None
             
 #===================================================== 
 def dialog(prompt):
@@ -880,122 +2003,517 @@ def test_align():
     exit_on_keypress()
         
 #=====================================================
-def exit_on_keypress():
+def exit_on_keypress(code=Exit_error):
+    """
+    wait for a key before leaving (interactive mode)
+    in batch mode, leave at once with exit code
+    only called by main() and test_align, processing steps raise PhautomError
+    """
+    if not Interactive: sys.exit(code)
     print("\nPress a key to exit")
     try: input()                                                     
-    except ValueError: pass
-    os._exit(1)
+    except (ValueError, EOFError): pass
+    os._exit(code)
 
 #=====================================================
-def create_parameters(parameters):
-# create and initialize variables from parameters
-    faux=["f", "n", "no", "non", "false"]
-    booleans=["v", "o", "y", "yes", "oui", "true"]+faux
-    for k, v  in parameters.items():
-        if isinstance(v, str) and not k in not_bool:   # make sure booleans are recognized
-            if v.lower().strip(' ') in booleans:
-                v=not(v.lower().strip(' ') in faux)
-                parameters[k]=v
+def parse_arguments(argv=None):
+    """
+    command line options, all optional
+    without --batch, parameters are edited in a window and the program waits for a key at the end
+    """
+    parser=argparse.ArgumentParser(description="Align photometry and behavior files, build trial databases")
+    parser.add_argument("-p", "--parameters", default=Param_file,
+                        help="JSON parameter file (default: %(default)s)")
+    parser.add_argument("-d", "--data-dir",
+                        help="directory containing behavior and photometry files (default: ./"+Input_subdir+")")
+    parser.add_argument("-o", "--output-dir",
+                        help="directory receiving databases and logs (default: ./"+Output_subdir+")")
+    parser.add_argument("-r", "--regions", type=int, nargs="+", choices=(1, 2),
+                        help="regions to process (default: all regions of parameter file)")
+    parser.add_argument("--realign", action="store_true",
+                        help="recompute alignment of all sessions, ignoring cached results")
+    parser.add_argument("-R", "--recursive", action="store_true",
+                        help="also look for sessions in sub-directories of data directory (cohort/animal/day)")
+    parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                        help="only sessions whose path relative to data directory matches PATTERN, e.g. 'cohort2/*' (repeatable)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                        help="skip sessions whose relative path matches PATTERN, e.g. '*/habituation/*' (repeatable)")
+    parser.add_argument("-P", "--prefetch", type=int, default=Prefetch_sessions, metavar="N",
+                        help="read the next N sessions in a background thread while processing (default: %(default)s)")
+    parser.add_argument("-b", "--batch", action="store_true",
+                        help="headless run: no parameter window, no plots, no keypress; errors set the exit code")
+    return parser.parse_args(argv)
+
+#==================================================
+def read_session(behav_name, cfg, cache_dir=None):
+    """
+    read behavior file and TTL inputs of photometry file of one session
+    Parameters
+    -----------
+        behav_name: full name of behavior file, photometry file has same name and Photom_ext
+        cfg: Config
+        cache_dir: directory of cached behavior sheets, see read_behav_file
+    Returns
+    -------
+        behav_lines: a Pandas dataframe
+        behav_times, photom_times: lists of TTL times in milliseconds
+    """
+    photom_name=os.path.splitext(behav_name)[0]+Photom_ext
+    behav_lines = read_behav_file(behav_name, cfg.Behav_time, cache_dir)
+    behav_times=get_behav_times(behav_lines, cfg)
+    photom_times=get_photom_times(photom_name, cfg)
+    return behav_lines, behav_times, photom_times
+
+#==================================================
+def align_session(behav_times, photom_times, cfg):
+    """
+    choose alignment procedure according to cfg and ask_offset
+    Returns
+    -------
+        offset, drift, matches, fit, bias, size (see align_drift)
+    """
+    drift=0.0
+    if cfg.Drift_correction and not ask_offset:
+        return align_drift(behav_times, photom_times, cfg.Approximation, cfg.Min_offset, cfg.Max_offset, cfg.Max_drift)
+    if ask_offset:
+        offset=dialog("\nPlease select offset in ms. ")
+        try: offset=int(offset)
+        except ValueError:
+            raise PhautomError()
+        offset, matches, fit, bias, size = align(behav_times, photom_times, span=cfg.Approximation, start=offset, end=offset)
+    else:
+        offset, matches, fit, bias, size  = align(behav_times, photom_times, span=cfg.Approximation, start=cfg.Min_offset, end=cfg.Max_offset)
+    return offset, drift, matches, fit, bias, size
+
+#==================================================
+def alignment_key(behav_times, photom_times, cfg):
+    """
+    fingerprint of TTL times and of parameters affecting alignment
+    """
+    key=hashlib.sha1(np.asarray(behav_times, dtype=float).tobytes())
+    key.update(np.asarray(photom_times, dtype=float).tobytes())
+    settings=[cfg.Approximation, cfg.Min_offset, cfg.Max_offset, cfg.Synchro_codes,
+              cfg.Drift_correction, cfg.Max_drift, Refine, len(behav_times)]
+    key.update(json.dumps(settings, sort_keys=True).encode())
+    return key.hexdigest()
+
+#==================================================
+def read_alignment_cache(cache_dir, key):
+    """
+    return alignment (offset, drift, matches, fit, bias, size) stored under key, None if absent
+    """
+    try:
+        with open(os.path.join(cache_dir, key+".json"), "r") as cache_file:
+            return tuple(json.load(cache_file)["alignment"])
+    except (IOError, ValueError, KeyError):
+        return None
+
+#==================================================
+def read_session_data(behav_name, cfg, regions, cache_dir=None):
+    """
+    read all files of one session, for processing by process_session
+    Parameters
+    -----------
+        behav_name: full name of behavior file, photometry file has same name and Photom_ext
+        cfg: Config
+        regions: regions whose photometry data are read
+        cache_dir: directory of cached behavior sheets, see read_behav_file
+    Returns
+    -------
+        behav_lines, behav_times, photom_times: see read_session
+        photom_data: see get_photom_data, None if no TTL inputs
+    """
+    photom_name=os.path.splitext(behav_name)[0]+Photom_ext
+    behav_lines, behav_times, photom_times = read_session(behav_name, cfg, cache_dir)
+    photom_data=None
+    if photom_times:
+        photom_data=get_photom_data(regions, photom_name, Photom_time_base, Photom_skip_header, cfg.signal_dtype)
+    return behav_lines, behav_times, photom_times, photom_data
+
+#==================================================
+def prefetch_sessions(behav_list, cfg, regions, cache_dir, depth):
+    """
+    read sessions in a background thread, at most 'depth' sessions ahead of processing
+    files of next sessions are read and parsed while current session is aligned and exported
+    errors of the reading thread (PhautomError) are raised again when their session is reached
+    Parameters
+    -----------
+        behav_list: full names of behavior files
+        cfg, regions, cache_dir: see read_session_data
+        depth: size of queue of sessions read in advance
+    Yields
+    -------
+        behav_name, data: data of session, see read_session_data
+    """
+    queue=Queue(maxsize=depth)
+    stop=threading.Event()                                                    # set when sessions are no longer consumed
+
+    def reader():
+        for behav_name in behav_list:
+            try: item=(behav_name, read_session_data(behav_name, cfg, regions, cache_dir), None)
+            except BaseException as error: item=(behav_name, None, error)
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    break
+                except Full: pass
+            if stop.is_set() or item[2] is not None: return
+
+    threading.Thread(target=reader, daemon=True).start()
+    try:
+        for i in range(len(behav_list)):
+            behav_name, data, error = queue.get()
+            if error is not None: raise error
+            yield behav_name, data
+    finally:
+        stop.set()
+
+#==================================================
+def write_alignment_cache(cache_dir, key, alignment, session):
+    """
+    store alignment under key, one small json file per session
+    written to a temporary file first, so that parallel runs never read a partial file
+    """
+    make_subdir(cache_dir)
+    cache_name=os.path.join(cache_dir, key+".json")
+    offset, drift, matches, fit, bias, size = alignment
+    entry={"session": session,
+           "alignment": [offset if isinstance(offset, int) else float(offset), float(drift),
+                         int(matches), float(fit), float(bias), int(size)]}
+    try:
+        with open(cache_name+".tmp"+str(os.getpid()), "w") as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(cache_name+".tmp"+str(os.getpid()), cache_name)
+    except IOError:
+        print(File_error, cache_name, "***")                             # not fatal, alignment will be recomputed
+
+#==================================================
+def session_name(behav_name, directory_in):
+    """
+    name of session: path of behavior file relative to data directory, without extension, / replaced by _
+    (file name alone for files at top of data directory)
+    """
+    relative=os.path.relpath(os.path.splitext(behav_name)[0], directory_in)
+    if relative.startswith(os.pardir): relative=os.path.basename(relative)             # target of a shortcut
+    return relative.replace(os.sep, "_")
+
+#==================================================
+def session_groups(behav_name, directory_in):
+    """
+    animal and cohort of a session, from path of behavior file relative to data directory:
+    cohort/animal/(day/)session, animal/session, or animal_session at top of data directory (animal before first _)
+    cohort is the data directory if not in path
+    """
+    relative=os.path.relpath(behav_name, directory_in)
+    parts=[] if relative.startswith(os.pardir) else list(Path(relative).parts[:-1])     # target of a shortcut
+    if len(parts)>1: return parts[1], parts[0]
+    animal=parts[0] if parts else os.path.splitext(os.path.basename(behav_name))[0].split("_")[0]
+    return animal, os.path.basename(os.path.normpath(directory_in))
+
+#==================================================
+def moments(x):
+    """
+    count, mean and sum of squared deviations (M2) of samples, float64 accumulators
+    """
+    x=np.asarray(x, dtype=float)
+    mean=x.mean()
+    return len(x), float(mean), float(np.square(x-mean).sum())
+
+#==================================================
+def merge_moments(a, b):
+    """
+    count, mean and M2 of two sets of samples together, from their own (Chan et al. update of Welford algorithm)
+    """
+    (count_a, mean_a, m2_a), (count_b, mean_b, m2_b) = a, b
+    count=count_a+count_b
+    if not count: return 0, 0.0, 0.0
+    delta=mean_b-mean_a
+    return count, mean_a+delta*count_b/count, m2_a+m2_b+delta*delta*count_a*count_b/count
+
+#==================================================
+def update_z_statistics(statistics_name, session, groups, region_moments):
+    """
+    store moments of deltaF/F of one session and update mean and stdev of its animal and cohort
+    totals are merged from moments of sessions, so that a session processed again replaces its previous moments
+    (of the regions processed, moments of other regions are kept)
+    file content: {"sessions": {session: {"animal": name, "cohort": name, region key: [count, mean, M2]}},
+                      "animal": {name: {region key: [count, mean, stdev]}}, "cohort": {...}}
+    Parameters
+    -----------
+        statistics_name: full name of json file
+        session: name of session
+        groups: (animal, cohort) of session, see session_groups
+        region_moments: a list of (region key, (count, mean, M2)), see moments
+    """
+    try:
+        with open(statistics_name, "r") as statistics_file:
+            statistics=json.load(statistics_file)
+    except (IOError, ValueError):
+        statistics={"sessions": {}}
+    entry={"animal": groups[0], "cohort": groups[1]}
+    entry.update({str(key): list(region) for key, region in region_moments})
+    statistics["sessions"].setdefault(session, {}).update(entry)          # other regions of session are kept
+
+    for level in ("animal", "cohort"):
+        totals={}
+        for entry in statistics["sessions"].values():
+            group=totals.setdefault(entry[level], {})
+            for key, region in entry.items():
+                if not key in ("animal", "cohort"): group[key]=merge_moments(group.get(key, (0, 0.0, 0.0)), region)
+        statistics[level]={name: {key: [count, mean, float(np.sqrt(m2/(count-1))) if count>1 else 0.0]
+                                                for key, (count, mean, m2) in group.items()} for name, group in totals.items()}
+    try:
+        with open(statistics_name+".tmp"+str(os.getpid()), "w") as statistics_file:
+            json.dump(statistics, statistics_file, indent=1)
+        os.replace(statistics_name+".tmp"+str(os.getpid()), statistics_name)
+    except IOError:
+        print(File_error, statistics_name," file may be open ***\n")
+        raise PhautomError(Exit_file)
+
+#==================================================
+def process_session(behav_name, cfg, directory_out, regions=None, realign=False, qc_pool=None, session=None, data=None, groups=None):
+    """
+    align one session and append its trials to the databases of each region
+    Parameters
+    -----------
+        behav_name: full name of behavior file, photometry file has same name and Photom_ext
+        cfg: Config
+        directory_out: directory of databases, logs are written in its Logs_subdir
+            databases of each anchor in a sub directory if Align_on is a list, see Config.anchor_configs
+        regions: regions to process, default all regions of cfg
+        realign: if True, alignment is recomputed even if found in cache
+        qc_pool: optional process pool rendering QC figures in the background, if QC_plots
+        session: name of session in logs, QC figures and trial store, default name of behavior file
+        data: files of session read in advance, see read_session_data, default read here
+        groups: (animal, cohort) of session for Group_z_score, default from name and directory of behavior file
+    Returns
+    -------
+        True if session could be aligned
+    """
+    regions=regions or range(1, cfg.Regions+1)
+    photom_name=os.path.splitext(behav_name)[0]+Photom_ext
+    session=session or os.path.splitext(os.path.basename(behav_name))[0]
+    groups=groups or session_groups(behav_name, os.path.dirname(behav_name))
+    print("\nOpening", os.path.basename(behav_name))
+
+    # read events and TTL inputs
+    cache_dir=os.path.join(directory_out, Cache_subdir)
+    if data is None: data=read_session(behav_name, cfg, None if cfg.Visualize else cache_dir)+(None,)
+    behav_lines, behav_times, photom_times, photom_data = data
+    if not photom_times:
+        print("\n*** No TTL inputs found ***")
+        return False
+
+    # synchronize        
+    print("Behavior:", len(behav_times),"events, Photometry:", len(photom_times),"inputs")
+    key=alignment_key(behav_times, photom_times, cfg)
+    alignment=None if realign or ask_offset else read_alignment_cache(cache_dir, key)
+    if alignment:
+        print("Alignment found in cache")
+    else:
+        alignment=align_session(behav_times, photom_times, cfg)
+        if alignment[0] is not None and not ask_offset and not cfg.Visualize:
+            write_alignment_cache(cache_dir, key, alignment, os.path.basename(behav_name))
+    offset, drift, matches, fit, bias, size = alignment
+    if offset is None:
+        print("\n*** No data to align ! ***")
+        return False                                                                 # do not create event timestamps
+    print("Offset: {time:.3f} s".format(time=offset/Photom_out_unit))
+
+    # log aligned events
+    if not cfg.Visualize:
+        fitstring="Fit: {time:.1f} ms  ".format(time=fit/matches)
+        fitstring+="Bias: {time:.1f} ms  ".format(time=bias/matches)
+        fitstring+="Matches: "+str(matches)+ " / "+str(size)
+        if cfg.Drift_correction: fitstring+="  Drift: {ppm:.1f} ppm".format(ppm=drift*1e6)
+        print(fitstring, end="   ")
+        if matches/size<Reliability_threshold:
+            print("*** Warning: unreliable alignment ***", end="   ")
+        print()
+        log_filename=session+Log_ext
+        log_global_name=os.path.join(directory_out, Log_summary_name)
+        log_filename=os.path.join(directory_out, Logs_subdir, "_log_"+log_filename)
+        if cfg.Filter: fitstring+="\n"+filter_string(cfg)                       # processing recorded in logs
+        make_log(log_global_name, log_filename, behav_times, photom_times, offset, fitstring, drift)
+
+    # read photom data once (unless read in advance), timestamps and trial times are shared by regions
+    if photom_data is None:
+        photom_data=get_photom_data(regions, photom_name, Photom_time_base, Photom_skip_header, cfg.signal_dtype)
+    ignore=int(cfg.Ignore_first_seconds*1000/(cfg.Photom_interval*Photom_time_base))
+    tim=photom_data[Timestamp].to_numpy()[ignore:]
+    anchors=[(anchor_cfg, anchor_dir)+get_trial_times(behav_lines, offset, tim[0], tim[-1], anchor_cfg, drift)
+             for anchor_cfg, anchor_dir in cfg.anchor_configs(directory_out)]
+
+    jobs, glitches = [], []
+    for region in regions:
+        iso=photom_data[Iso[region]].to_numpy()[ignore:]
+        sig=photom_data[Sig[region]].to_numpy()[ignore:]
+
+        # glitches of either channel, before regression
+        region_glitches=None
+        if cfg.Glitch_removal:
+            region_glitches=find_glitches(sig, cfg) | find_glitches(iso, cfg)
+            if cfg.Glitch_removal=="interpolate":
+                sig, iso = interpolate_glitches(tim, sig, region_glitches), interpolate_glitches(tim, iso, region_glitches)
+        glitches.append(region_glitches)
+        jobs.append((region, tim, sig, iso, cfg))
+        
+    # deltaF/F of each region, regions in parallel threads (numpy releases the GIL)
+    if cfg.Visualize or len(jobs)==1:
+        results=[prepare_photom(*job) for job in jobs]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            results=[result.result() for result in [pool.submit(prepare_photom, *job) for job in jobs]]     # raise errors of threads
+    if cfg.Visualize: return True
+
+    # add to behavior and photometry databases of each anchor
+    store, region_moments = [], []
+    trial_groups=groups if cfg.Group_z_score else None                # animal and cohort columns
+    if cfg.Storage!="sqlite":                                                      # columns checked before writing any database
+        for region in regions:
+            for anchor_cfg, anchor_dir, times, keep in anchors:
+                behav_filename, photom_filename = [os.path.join(anchor_dir, name) for name in cfg.database_names(region)]
+                check_titles(behav_filename, behav_titles(behav_lines, cfg.Glitch_removal, cfg.Transients, cfg.Group_z_score))
+                check_titles(photom_filename, photom_titles(anchor_cfg))
+    for region, region_glitches, (region_panels, linear_fit, delta_f_f) in zip(regions, glitches, results):
+        if cfg.Group_z_score: region_moments.append((cfg.region_key(region), moments(delta_f_f)))
+        transients=None
+        if cfg.Transients:
+            transients=find_transients(tim, delta_f_f, cfg)
+            write_transients(os.path.join(directory_out, Transients_subdir, session+"_"+str(region)+Transients_ext), transients)
+        rows, trials = [], []
+        for anchor_cfg, anchor_dir, times, keep in anchors:
+            behav_filename, photom_filename = [os.path.join(anchor_dir, name) for name in cfg.database_names(region)]
+            artifacts=None if region_glitches is None else artifact_fractions(tim, region_glitches, times, anchor_cfg)
+            counts=None if transients is None else transient_counts(transients, times, anchor_cfg)
+            if cfg.Storage=="sqlite":
+                trial_times=[(time, "") for time in times[keep]]                           # matched by id in trial store
+                rows.append(store_rows(behav_lines, keep, artifacts, counts, trial_groups))
             else:
-                print("\nIncorrect parameter", k, ":", v)
-                print("Allowed values are :", booleans)
-                exit_on_keypress()
-        globals()[k]=v
+                trial_times=export_behav(photom_name, behav_filename, behav_lines, times, keep, artifacts, counts, trial_groups)
+            trials.append(export_epochs(photom_filename, tim, delta_f_f, linear_fit, trial_times, anchor_cfg))
+        store.append((rows, trials))
+
+    # all regions of session in trial store of each anchor at once
+    if cfg.Storage=="sqlite":
+        for i, (anchor_cfg, anchor_dir, times, keep) in enumerate(anchors):
+            write_store(os.path.join(anchor_dir, Store_name), session,
+                              [(cfg.region_key(region), rows[i], trials[i]) for region, (rows, trials) in zip(regions, store)], anchor_cfg)
+
+    # moments of whole session for animal and cohort z-scores, next to databases of each anchor
+    if cfg.Group_z_score:
+        for anchor_cfg, anchor_dir, times, keep in anchors:
+            update_z_statistics(os.path.join(anchor_dir, Z_statistics_name), session, groups, region_moments)
+
+    # QC figures, rendered by another process while next session is processed
+    if cfg.QC_plots:
+        for region, (region_panels, linear_fit, delta_f_f) in zip(regions, results):
+            png_name=os.path.join(directory_out, QC_subdir, session+"_"+str(region)+QC_ext)
+            title=session+" - region "+str(region)
+            if qc_pool: qc_pool.submit(render_qc, png_name, title, region_panels)
+            else: render_qc(png_name, title, region_panels)
+
+    return True
 
 #================================================== MAIN PROGRAM
-# test alignment procedure
-##test_align()                                                                    # only in debugging phase
-
-# set and assign parameters
-parameters=set_parameters(Param_file)            # get last parameters used, adjust if necessary
-create_parameters(parameters)
-print(parameters)
-
-Synchro_codes=eval(Synchro_codes)   # convert string to dict
-Behav_database_name[1]="Behav_data1.xls" if Regions==2 else "Behav_data.xls" 
-Photom_database_name[1]="Photom_data1.xls" if Regions==2 else "Photom_data.xls" 
-
-# current directory
-directory= os.getcwd()                                                        # current program and data directory
-directory_in= os.path.join(directory, Input_subdir)
-directory_out= os.path.join(directory, Output_subdir)
-directory_logs=os.path.join(directory, Logs_subdir)
-if not Visualize:
-    make_subdir(directory_out)                                           # create dir if necessary
-    make_subdir(directory_logs)                                          # create dir if necessary
-
-print("Working on", directory)
-
-# files in current directory (remove caps)
-behav_list, Behav_time = get_file_list(directory_in,  Behav_ext, Behav_ext_WhandA, Behav_time, Behav_time_Whanda)
-
-# loop on all files
-for behav_name in behav_list:
-
-    offset=None
-    for region in range(1,Regions+1):
-
-        if offset is None:
-            # read behavior file in totality
-            photom_name=os.path.join(os.path.splitext(behav_name)[0])+Photom_ext        
-            print("\nOpening", behav_name.split("\\")[-1])
-            behav_lines=[]
-            behav_lines = read_behav_file(behav_name, Behav_header_size)
-
-            # read events and TTL inputs
-            behav_times=get_behav_times(behav_lines, Behav_time_unit)
-            photom_times=get_photom_times(photom_name, Photom_time_base, Photom_interval, Photom_skip_header)
-            if not photom_times:
-                print("\n*** No TTL inputs found ***")
-                break
-            Max_time=photom_times[-1]
-
-            # synchronize        
-            print("Behavior:", len(behav_times),"events, Photometry:", len(photom_times),"inputs")
-            if ask_offset:
-                offset=dialog("\nPlease select offset in ms. ")
-                try: offset=int(offset)
-                except ValueError:
-                    exit_on_keypress()
-                offset, matches, fit, bias, size = align(behav_times, photom_times, span=Approximation, start=offset, end=offset)
-            else:
-                offset, matches, fit, bias, size  = align(behav_times, photom_times, span=Approximation, start=Min_offset, end=Max_offset)
-            if offset is None:
-                print("\n*** No data to align ! ***")
-                continue                                                                     # do not create event timestamps
-            print("Offset: {time:.3f} s".format(time=offset/Photom_out_unit))
-
-            # log aligned events
-            if not Visualize:
-                fitstring="Fit: {time:.1f} ms  ".format(time=fit/matches)
-                fitstring+="Bias: {time:.1f} ms  ".format(time=bias/matches)
-                fitstring+="Matches: "+str(matches)+ " / "+str(size)
-                print(fitstring, end="   ")
-                if matches/size<Reliability_threshold:
-                    print("*** Warning: unreliable alignment ***", end="   ")
-                print()
-                log_filename=os.path.splitext(photom_name.split("\\")[-1])[0]+Log_ext
-                log_global_name=os.path.join(directory_out, Log_summary_name)
-                log_filename=os.path.join(directory_logs, "_log_"+log_filename)
-                make_log(log_global_name, log_filename, behav_times, photom_times, offset, fitstring)      
-
-        # read photom data for region            
-        photom_data=get_photom_data(region, photom_name, Photom_time_base, Photom_skip_header)
-        ignore=int(Ignore_first_seconds*1000/(Photom_interval*Photom_time_base))
-        iso=photom_data[Iso[region]][ignore:]
-        sig=photom_data[Sig[region]][ignore:]
-        tim=photom_data['TimeStamp'][ignore:]
-
-        # add to behavior database
-        trial_times=[]
-        if not Visualize:
-            behav_filename=os.path.join(directory_out, Behav_database_name[region])
-            min_t, max_t = photom_data[Timestamp][ignore], list(photom_data[Timestamp])[-1]
-            trial_times=export_behav(photom_name, behav_filename, behav_lines, Behav_time, offset, min_t, max_t)
-        
-        # add to photometry database
-        photom_filename=os.path.join(directory_out, Photom_database_name[region])
-        export_photom(region, photom_filename, photom_data, tim, sig, iso, trial_times)
+def main(argv=None):
+    """
+    align all sessions of data directory and append their trials to databases
+    Parameters
+    -----------
+        argv: list of command line arguments, default sys.argv[1:]
+    Returns
+    -------
+        exit code: Exit_ok, or Exit_alignment if some sessions could not be aligned
+    """
+    global Interactive
+    print("\nPhautom - 12/03/2025 - Alain R. Marchand\n")
+    args=parse_arguments(argv)
+    Interactive=not args.batch
+    if not Interactive and Import_time>Import_time_budget:
+        print("Slow start: module imports took {t:.2f} s (budget {b:.2f} s)".format(t=Import_time, b=Import_time_budget))
+
+    try: code=run(args)
+    except PhautomError as error: code=error.code                   # message printed by failing step
+    if Interactive: exit_on_keypress(code)
+    return code
 
-exit_on_keypress()
+#==================================================
+def run(args):
+    """
+    processing steps of main(), errors raise PhautomError
+    Parameters
+    -----------
+        args: command line options, see parse_arguments
+    Returns
+    -------
+        exit code: Exit_ok, or Exit_alignment if some sessions could not be aligned
+    """
+    # test alignment procedure
+    ##test_align()                                                                    # only in debugging phase
 
+    # set and assign parameters
+    if Interactive:
+        parameters=set_parameters(args.parameters)            # get last parameters used, adjust if necessary
+    else:
+        parameters=load_parameters_from_json(args.parameters)
+    cfg=Config.from_parameters(parameters)
+    print(cfg)
+    if not Interactive and cfg.Visualize:
+        print("Batch mode: Visualize is ignored")
+        cfg=replace(cfg, Visualize=False)
+    if not Interactive and ask_offset:
+        print("\n*** Error: ask_offset is not available in batch mode ***")
+        raise PhautomError(Exit_parameter)
+
+    regions=sorted(set(args.regions)) if args.regions else range(1, cfg.Regions+1)
+    if max(regions)>cfg.Regions:
+        print("\n*** Error: region", max(regions), "requested, parameter file has", cfg.Regions, "region(s) ***")
+        raise PhautomError(Exit_parameter)
+
+    # current directory
+    directory= os.getcwd()                                                        # current program and data directory
+    directory_in= args.data_dir or os.path.join(directory, Input_subdir)
+    directory_out= args.output_dir or os.path.join(directory, Output_subdir)
+    if not cfg.Visualize:
+        make_subdir(directory_out)                                           # create dir if necessary
+        make_subdir(os.path.join(directory_out, Logs_subdir))      # create dir if necessary
+        make_subdir(os.path.join(directory_out, Cache_subdir))    # before shortcuts are resolved and cached
+        for anchor_cfg, anchor_dir in cfg.anchor_configs(directory_out):
+            make_subdir(anchor_dir)                                           # databases of each anchor
+    if cfg.QC_plots:
+        make_subdir(os.path.join(directory_out, QC_subdir))       # create dir if necessary
+    if cfg.Transients and not cfg.Visualize:
+        make_subdir(os.path.join(directory_out, Transients_subdir))   # create dir if necessary
+
+    print("Working on", directory_in)
+
+    # files in current directory (remove caps)
+    behav_list, Behav_time = get_file_list(directory_in,  Behav_ext, Behav_ext_WhandA, cfg.Behav_time, Behav_time_Whanda,
+                                                        recursive=args.recursive, include=args.include, exclude=args.exclude,
+                                                        cache_dir=os.path.join(directory_out, Cache_subdir))
+    cfg=replace(cfg, Behav_time=Behav_time)
+
+    # loop on all files, next files read in advance if prefetch, QC figures of sessions rendered in parallel processes
+    qc_pool=None
+    if cfg.QC_plots and len(behav_list)>1:
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context
+        qc_pool=ProcessPoolExecutor(mp_context=get_context("spawn"))     # workers do not inherit threads or open files
+    if args.prefetch>0:
+        cache_dir=None if cfg.Visualize else os.path.join(directory_out, Cache_subdir)
+        sessions=prefetch_sessions(behav_list, cfg, regions, cache_dir, args.prefetch)
+    else:
+        sessions=((behav_name, None) for behav_name in behav_list)
+    failed=[behav_name for behav_name, data in sessions
+            if not process_session(behav_name, cfg, directory_out, regions, args.realign, qc_pool,
+                                          session_name(behav_name, directory_in), data, session_groups(behav_name, directory_in))]
+    if qc_pool: qc_pool.shutdown()                                      # wait for last figures
+
+    if failed:
+        print("\n***", len(failed), "session(s) could not be aligned:", ", ".join(os.path.basename(f) for f in failed), "***")
+    return Exit_alignment if failed else Exit_ok
+
+if __name__ == "__main__":
+    sys.exit(main())